@@ -3,14 +3,16 @@ import logging
 import os
 import threading, schedule, time
 
-from ..runner.spearman_runner import SpearManRunner
-from ..runner.pearson_runner import PearsonRunner
+from ..runner.runner import Runner, UnsupportedMeasure
+from ..processor.scheduler import SchedulerBusy
+from ..runner import columns as column_format
 from ..conf.app_conf import *
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 
 logger = logging.getLogger(__name__)
 pattern_matcher_controller = Blueprint('pattern_matcher_controller', __name__, template_folder='controller')
 runner = None
+precompute_thread = None
 
 def runner_init(): 
     conf_file = os.path.join(os.path.dirname(__file__), '..', 'conf', 'conf.json')
@@ -18,27 +20,68 @@ def runner_init():
     logger.info('Initializing application ...')
     # read conf
     conf = getconf(conf_file, logger)
-    # init runner
-    meaure_type = conf['measurement']['type'].lower()
+    # init runner, measurement.type is the default measure, a request can ask for another
     global runner
-    if meaure_type == 'spearman':
-        runner = SpearManRunner(conf)
-    elif meaure_type == 'pearson':
-        runner = PearsonRunner(conf)
-    else:
-        raise Exception('Unsupported measurement type: {}'.format(meaure_type))
+    runner = Runner(conf)
+    # poll the data directory for appended rows and new tickers
+    schedule.every(int(conf['input'].get('poll_interval', 60))).seconds.do(runner_refresh)
+    # and re-read all of it nightly, in case a file was changed in a way refresh could not follow
+    schedule.every().day.at(conf['input'].get('reload_at', '00:05')).do(runner_reload)
+    # rebuild the precomputed match table nightly, the collector can also ask for it through /precompute/
+    if conf.get('precompute', {}).get('enabled', False) is True:
+        schedule.every().day.at(conf['precompute'].get('at', '02:00')).do(runner_precompute)
     # run update runner
     scheduler_thread = threading.Thread(target=update_runner, daemon=True)
     scheduler_thread.start()
 
+# the scheduled jobs log their failures, an exception escaping schedule.run_pending() would end the
+# only scheduler thread and with it every later refresh, reload and precomputation
+
+def runner_reload():
+    # reload data in place so the runner's worker pool survives
+    logger.info('Reloading pattern matcher data ...')
+    try:
+        runner.reload()
+    except Exception as e:
+        logger.error('Failed to reload pattern matcher data. Exception follows. %s', e)
+
+def runner_refresh():
+    try:
+        changed = runner.refresh()
+    except Exception as e:
+        logger.error('Failed to refresh pattern matcher data. Exception follows. %s', e)
+        return None
+    if changed:
+        logger.info('Refreshed %s tickers', len(changed))
+    return changed
+
+def runner_precompute():
+    # a build takes minutes, keep it off the scheduler thread so polling goes on
+    global precompute_thread
+    if precompute_thread is not None and precompute_thread.is_alive():
+        logger.info('Precomputation already running')
+        return False
+    precompute_thread = threading.Thread(target=precompute_table, daemon=True)
+    precompute_thread.start()
+    return True
+
+def precompute_table():
+    try:
+        runner.precompute()
+    except Exception as e:
+        logger.error('Failed to precompute the match table. Exception follows. %s', e)
+
 def update_runner():
     while True:
-        logger.info("Updating new collected data ...")
         schedule.run_pending()
-        time.sleep(3600)
+        time.sleep(1)
+
+def busy(e):
+    # every scan slot is taken and the queue is full, tell the client how long the line is
+    logger.info('Rejecting request: %s', e)
+    return jsonify({"error": "Too many requests", "queued": e.queued, "retry_after": e.retry_after}), 429, {'Retry-After': str(e.retry_after)}
 
 runner_init()
-schedule.every().day.at("00:05").do(runner_init)
 @pattern_matcher_controller.route('/match/', methods=['GET'])
 def match():
     params = request.args.to_dict()
@@ -47,9 +90,129 @@ def match():
     days_back = int(params['days_back'])
     days_forward = int(params['days_forward'])
     top = int(params['top'])
+    # optional time budget, the best matches found when it runs out come back with complete: false
+    budget = float(params['budget_ms']) / 1000. if 'budget_ms' in params else None
+    # the compact parallel-array response with format=columns or format=binary, or the matching Accept header
+    accepted = list(request.accept_mimetypes.values())
+    binary = params.get('format') == 'binary' or column_format.COLUMNS_BINARY in accepted
+    columns = binary or params.get('format') == 'columns' or column_format.COLUMNS_JSON in accepted
+    # measure=pearson overrides the configured measure, measure=pearson,spearman ranks by both at once
+    measure = params.get('measure')
+    # channels=close,volume matches the pattern on several columns of the ticker files, closes alone by default
+    channels = params.get('channels')
+
+    try:
+        result = runner.match(ticker, days_back, days_forward, top, budget, columns, measure, channels)
+        begin_time = time.time()
+        if binary:
+            response = Response(column_format.encode_binary(result), mimetype=column_format.COLUMNS_BINARY)
+        elif columns:
+            response = Response(column_format.encode_json(result), mimetype=column_format.COLUMNS_JSON)
+        else:
+            response = jsonify(result)
+        logger.info('Serialized %s matches as %s: %s bytes in %.2fms', top, response.mimetype, response.content_length, (time.time() - begin_time) * 1000)
+        return response
+    except NameError as e:
+        logger.error("Data for ticker {} does not exist".format(ticker))
+        return jsonify({"error": "Data not found".format(ticker)}), 400
+    except UnsupportedMeasure as e:
+        return jsonify({"error": str(e)}), 400
+    except SchedulerBusy as e:
+        return busy(e)
+
+@pattern_matcher_controller.route('/match/jobs/', methods=['POST'])
+def submit_match():
+    # {"ticker": ..., "days_back": ..., "days_forward": ..., "top": ..., "budget_ms", "measure" and "channels" optional}, poll the returned id
+    body = request.get_json(silent=True) or {}
+    logger.info('Submit match job with params: %s', body)
+    try:
+        ticker = body['ticker'].upper()
+        days_back = int(body['days_back'])
+        days_forward = int(body['days_forward'])
+        top = int(body['top'])
+        budget = float(body['budget_ms']) / 1000. if body.get('budget_ms') is not None else None
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        return jsonify({"error": "Invalid request: {0}".format(e)}), 400
+
+    try:
+        job = runner.submit_match(ticker, days_back, days_forward, top, budget, body.get('measure'), body.get('channels'))
+    except NameError as e:
+        logger.error("Data for ticker {} does not exist".format(ticker))
+        return jsonify({"error": "Data not found".format(ticker)}), 400
+    except UnsupportedMeasure as e:
+        return jsonify({"error": str(e)}), 400
+    except SchedulerBusy as e:
+        return busy(e)
+    return jsonify(runner.job(job.id)), 202
+
+@pattern_matcher_controller.route('/match/jobs/<int:job_id>/', methods=['GET'])
+def match_job(job_id):
+    state = runner.job(job_id)
+    if state is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(state)
+
+@pattern_matcher_controller.route('/match/stream/', methods=['GET'])
+def match_stream():
+    # NDJSON by default, Server-Sent Events with format=sse or an Accept: text/event-stream header
+    params = request.args.to_dict()
+    logger.info('Stream match pattern with params: %s', params)
+    ticker = params['ticker'].upper()
+    days_back = int(params['days_back'])
+    days_forward = int(params['days_forward'])
+    top = int(params['top'])
+    sse = params.get('format') == 'sse' or 'text/event-stream' in request.headers.get('Accept', '')
+    budget = float(params['budget_ms']) / 1000. if 'budget_ms' in params else None
 
     try:
-        return jsonify(runner.run(ticker, days_back, days_forward, top))
+        events = runner.match_stream(ticker, days_back, days_forward, top, budget, params.get('measure'), params.get('channels'))
     except NameError as e:
         logger.error("Data for ticker {} does not exist".format(ticker))
-        return jsonify({"error": "Data not found".format(ticker)}), 400
\ No newline at end of file
+        return jsonify({"error": "Data not found".format(ticker)}), 400
+    except UnsupportedMeasure as e:
+        return jsonify({"error": str(e)}), 400
+    except SchedulerBusy as e:
+        return busy(e)
+
+    def generate():
+        for event in events:
+            if sse:
+                yield 'event: {0}\ndata: {1}\n\n'.format(event['event'], json.dumps(event))
+            else:
+                yield json.dumps(event) + '\n'
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream' if sse else 'application/x-ndjson')
+    # the scan holds a scheduler turn until its events are closed, and a HEAD request never reads them
+    response.call_on_close(events.close)
+    return response
+
+@pattern_matcher_controller.route('/match/batch/', methods=['POST'])
+def match_batch():
+    # {"requests": [{"ticker": ..., "days_back": ..., "days_forward": ..., "top": ..., "measure" and "channels" optional}, ...]}
+    body = request.get_json(silent=True) or {}
+    requests = body.get('requests') if isinstance(body, dict) else None
+    if not isinstance(requests, list):
+        return jsonify({"error": "Expected a JSON body with a list of requests"}), 400
+    logger.info('Batch match of %s requests', len(requests))
+    try:
+        return jsonify({'results': runner.match_batch(requests)})
+    except SchedulerBusy as e:
+        return busy(e)
+
+@pattern_matcher_controller.route('/stats/', methods=['GET'])
+def stats():
+    return jsonify(runner.stats())
+
+@pattern_matcher_controller.route('/refresh/', methods=['POST'])
+def refresh():
+    # lets the collector ask for its writes to be picked up right away
+    changed = runner_refresh()
+    if changed is None:
+        return jsonify({'error': 'Refresh failed, see the server log'}), 500
+    return jsonify({'refreshed': changed})
+
+@pattern_matcher_controller.route('/precompute/', methods=['POST'])
+def precompute():
+    # the collector calls this once it has written the day's data
+    if runner.conf.get('precompute', {}).get('enabled', False) is not True:
+        return jsonify({'error': 'Precomputation is not enabled'}), 400
+    return jsonify({'started': runner_precompute()})
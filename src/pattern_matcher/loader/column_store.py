@@ -0,0 +1,93 @@
+import json, logging, os, shutil, time, uuid
+import numpy as np
+from .packed import load_published, compact_dates, epoch_millis, float64_closes
+
+logger = logging.getLogger(__name__)
+
+class ColumnStore:
+    """
+    Binary columnar cache of the ticker CSVs, memory-mapped instead of parsed on startup.
+    Every version is a directory laid out like PackedDataset.publish (offsets.npy, dates.npy,
+    closes.npy, tickers.json) plus sources.json, the read state of each source file, so only
+    sources that changed since are parsed again. CURRENT names the latest version. A compact store
+    writes int32 days and float32 closes like a compact PackedDataset
+    """
+
+    # versions kept on disk, the previous one may still be mapped by in-flight requests
+    _KEEP = 2
+
+    def __init__(self, directory, compact=False, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.directory = directory
+        self.compact = compact
+        os.makedirs(directory, exist_ok=True)
+
+    def current(self):
+        try:
+            with open(os.path.join(self.directory, 'CURRENT'), 'r') as f:
+                path = os.path.join(self.directory, f.read().strip())
+        except IOError:
+            return None
+        return path if os.path.isdir(path) else None
+
+    def load(self):
+        """ Return the memory-mapped PackedDataset of the current version and its source states """
+        path = self.current()
+        if path is None:
+            return None, dict()
+        try:
+            with open(os.path.join(path, 'sources.json'), 'r') as f:
+                sources = json.load(f)
+            return load_published(path), sources
+        except (IOError, ValueError) as e:
+            self.logger.error('Ignoring unreadable column store: %s. Exception follows. %s', path, e)
+            return None, dict()
+
+    def write(self, tickers, series, sources):
+        """
+        Write a new version holding tickers, series(ticker) giving the (dates, closes) arrays of each,
+        make it current and return it mapped as a PackedDataset
+        """
+        # names sort by creation time, which prune relies on
+        name = '{0:017d}-{1}'.format(int(time.time() * 10 ** 6), uuid.uuid4().hex[:8])
+        path = os.path.join(self.directory, name)
+        os.makedirs(path)
+
+        columns = [series(ticker) for ticker in tickers]
+        offsets = np.zeros(len(tickers) + 1, dtype=np.int64)
+        np.cumsum([dates.shape[0] for dates, _ in columns], out=offsets[1:])
+        # fill the files through a mapping so the universe is never held twice in memory
+        dates_out = np.lib.format.open_memmap(os.path.join(path, 'dates.npy'), mode='w+', dtype=np.int32 if self.compact else np.int64, shape=(int(offsets[-1]),))
+        closes_out = np.lib.format.open_memmap(os.path.join(path, 'closes.npy'), mode='w+', dtype=np.float32 if self.compact else np.float64, shape=(int(offsets[-1]),))
+        for i, (dates, closes) in enumerate(columns):
+            # unchanged tickers come from the previous version, which may have been written in the other representation
+            dates_out[offsets[i]:offsets[i + 1]] = compact_dates(dates) if self.compact else epoch_millis(dates)
+            closes_out[offsets[i]:offsets[i + 1]] = closes if self.compact else float64_closes(closes)
+        dates_out.flush()
+        closes_out.flush()
+        del dates_out, closes_out
+
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        with open(os.path.join(path, 'tickers.json'), 'w') as f:
+            json.dump(list(tickers), f)
+        with open(os.path.join(path, 'sources.json'), 'w') as f:
+            json.dump(sources, f)
+
+        pointer = os.path.join(self.directory, 'CURRENT.' + uuid.uuid4().hex[:8])
+        with open(pointer, 'w') as f:
+            f.write(name)
+        os.replace(pointer, os.path.join(self.directory, 'CURRENT'))
+        self.logger.info('Wrote column store version %s: %s tickers, %s bars', name, len(tickers), int(offsets[-1]))
+        self.prune()
+        return load_published(path)
+
+    def prune(self):
+        current = os.path.basename(self.current() or '')
+        versions = sorted(entry for entry in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, entry)))
+        for entry in versions[:-self._KEEP]:
+            if entry == current:
+                continue
+            try:
+                shutil.rmtree(os.path.join(self.directory, entry))
+            except OSError as e:
+                self.logger.error('Failed to remove column store version: %s. Exception follows. %s', entry, e)
@@ -1,5 +1,5 @@
 import pandas as pd
 import numpy as np
 
-def load(file_path, delimiter = ',', usecols=None):
-    return pd.read_csv(file_path, delimiter=delimiter, usecols=usecols)
+def load(file_path, delimiter = ',', usecols=None, **kwargs):
+    return pd.read_csv(file_path, delimiter=delimiter, usecols=usecols, **kwargs)
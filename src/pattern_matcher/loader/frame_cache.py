@@ -0,0 +1,101 @@
+import collections, logging, sys, threading
+from collections.abc import Mapping
+
+class FrameCache:
+    """
+    Parsed ticker frames held up to a byte budget, the least recently used are evicted first.
+    A frame larger than the whole budget is still held until the next one is read
+    """
+
+    def __init__(self, budget, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.budget = budget
+        self.resident = 0
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        # {ticker: (frame, bytes)} from least to most recently used
+        self._frames = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, ticker, read, admit=True):
+        """
+        The frame of ticker, read(ticker) parses it when it is not resident. Without admit a frame read
+        is not kept, so a full scan passing over every ticker once does not evict the frames in use
+        """
+        with self._lock:
+            entry = self._frames.get(ticker)
+            if entry is not None:
+                self._frames.move_to_end(ticker)
+                self.hits += 1
+                return entry[0]
+        # parsed outside the lock, two requests missing the same ticker at once both read it
+        frame = read(ticker)
+        size = sys.getsizeof(frame)
+        with self._lock:
+            self.loads += 1
+            if not admit:
+                return frame
+            previous = self._frames.pop(ticker, None)
+            if previous is not None:
+                self.resident -= previous[1]
+            self._frames[ticker] = (frame, size)
+            self.resident += size
+            while self.resident > self.budget and len(self._frames) > 1:
+                _, (_, evicted) = self._frames.popitem(last=False)
+                self.resident -= evicted
+                self.evictions += 1
+        return frame
+
+    def discard(self, tickers):
+        """ Drop the frames of tickers, e.g. once their files changed """
+        with self._lock:
+            for ticker in tickers:
+                entry = self._frames.pop(ticker, None)
+                if entry is not None:
+                    self.resident -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.resident = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'resident': self.resident,
+                'budget': self.budget,
+                'tickers': len(self._frames),
+                'hits': self.hits,
+                'loads': self.loads,
+                'evictions': self.evictions
+            }
+
+class LazyFrames(Mapping):
+    """ Read-only {ticker: DataFrame[date, close]} of ticker files parsed on first access and held by a FrameCache """
+
+    def __init__(self, tickers, cache, read):
+        self.tickers = list(tickers)
+        self.cache = cache
+        self.read = read
+        self._tickers = frozenset(self.tickers)
+
+    def __getitem__(self, ticker):
+        if ticker not in self._tickers:
+            raise KeyError(ticker)
+        return self.cache.get(ticker, self.read)
+
+    def stream(self, ticker):
+        """ The frame of ticker for a full scan, read without taking a place in the cache when it is not resident """
+        if ticker not in self._tickers:
+            raise KeyError(ticker)
+        return self.cache.get(ticker, self.read, admit=False)
+
+    def __contains__(self, ticker):
+        return ticker in self._tickers
+
+    def __iter__(self):
+        return iter(self.tickers)
+
+    def __len__(self):
+        return len(self.tickers)
@@ -0,0 +1,242 @@
+import json, logging, os, shutil, tempfile, uuid, weakref
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# datasets attached by this process, keyed by published path
+_ATTACHED = dict()
+
+# a compact dataset keeps dates as int32 days since the epoch and closes as float32, half the bytes
+_MILLIS_PER_DAY = 86400000
+
+def compact_dates(dates):
+    """ int32 days since the epoch of dates in either representation, dates are whole days """
+    dates = np.asarray(dates)
+    return dates if dates.dtype == np.int32 else (dates // _MILLIS_PER_DAY).astype(np.int32)
+
+def epoch_millis(dates):
+    """ int64 epoch milliseconds of dates in either representation """
+    dates = np.asarray(dates)
+    return dates.astype(np.int64) * _MILLIS_PER_DAY if dates.dtype == np.int32 else dates
+
+def float64_closes(closes):
+    """
+    float64 closes of closes in either representation. float32 holds about 7 significant digits,
+    values are rounded to those so a stored 52.35 comes back as 52.35 rather than 52.349998
+    """
+    closes = np.asarray(closes)
+    if closes.dtype != np.float32:
+        return closes
+    closes = closes.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = 10. ** (6 - np.floor(np.log10(np.abs(closes))))
+    scale = np.where(np.isfinite(scale), scale, 1.)
+    return np.round(closes * scale) / scale
+
+def ticker_prefix_sums(offsets, values):
+    """
+    Prefix sums of values and of their squares restarted at zero for every ticker, each ticker centered
+    on its own mean, so a cheap ticker keeps its precision next to expensive ones. The sums of ticker i
+    take positions offsets[i] + i to offsets[i + 1] + i: its bars a to b add up to sums[b + i] - sums[a + i]
+    """
+    values = np.asarray(values, dtype=np.float64)
+    sums = np.zeros(values.shape[0] + len(offsets) - 1, dtype=np.float64)
+    sums_sq = np.zeros(values.shape[0] + len(offsets) - 1, dtype=np.float64)
+    for i in range(len(offsets) - 1):
+        fr, to = offsets[i], offsets[i + 1]
+        if to > fr:
+            centered = values[fr:to] - values[fr:to].mean()
+            np.cumsum(centered, out=sums[fr + i + 1:to + i + 1])
+            np.cumsum(centered * centered, out=sums_sq[fr + i + 1:to + i + 1])
+    return sums, sums_sq
+
+def carried_bars(previous, dataset, changed):
+    """
+    What of previous still holds for dataset after the tickers in changed were re-read: (position in
+    dataset, position in previous) of every ticker previous holds unchanged, and the positions in dataset
+    of the other tickers, whose data derived from the bars has to be computed again
+    """
+    changed = set(changed)
+    kept, fresh = [], []
+    for i, ticker in enumerate(dataset.tickers):
+        if ticker in previous and ticker not in changed:
+            kept.append((i, previous.position(ticker)))
+        else:
+            fresh.append(i)
+    return kept, fresh
+
+class PackedDataset:
+    """
+    Close prices of the whole universe in one contiguous array.
+    Ticker tickers[i] owns closes[offsets[i]:offsets[i + 1]] and the parallel slice of dates.
+    Dates are int64 epoch milliseconds, or int32 days and float32 closes in a compact dataset
+    """
+
+    def __init__(self, tickers, offsets, dates, closes):
+        self.tickers = list(tickers)
+        self.offsets = offsets
+        self.dates = dates
+        self.closes = closes
+        # set by the runner to the snapshot version the arrays belong to
+        self.version = None
+        self._positions = {ticker: i for i, ticker in enumerate(self.tickers)}
+
+    @classmethod
+    def from_frames(cls, frames, compact=False):
+        """ Pack a {ticker: DataFrame[date, close]} mapping as loaded by Runner.load_data """
+        return cls.from_series(list(frames.keys()), lambda ticker: (frames[ticker].iloc[:, 0].values, frames[ticker].iloc[:, 1].values), compact)
+
+    @classmethod
+    def from_series(cls, tickers, series, compact=False):
+        """ Pack tickers, series(ticker) giving the (dates, closes) arrays of each in either representation """
+        columns = [series(ticker) for ticker in tickers]
+        offsets = np.zeros(len(tickers) + 1, dtype=np.int64)
+        np.cumsum([len(dates) for dates, _ in columns], out=offsets[1:])
+
+        dates = np.empty(offsets[-1], dtype=np.int32 if compact else np.int64)
+        closes = np.empty(offsets[-1], dtype=np.float32 if compact else np.float64)
+        for i, (ticker_dates, ticker_closes) in enumerate(columns):
+            dates[offsets[i]:offsets[i + 1]] = compact_dates(ticker_dates) if compact else epoch_millis(ticker_dates)
+            closes[offsets[i]:offsets[i + 1]] = ticker_closes if compact else float64_closes(ticker_closes)
+        return cls(tickers, offsets, dates, closes)
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def __contains__(self, ticker):
+        return ticker in self._positions
+
+    def position(self, ticker):
+        return self._positions[ticker]
+
+    def series(self, ticker):
+        """ Views of (dates, closes) for one ticker """
+        i = self._positions[ticker]
+        return self.dates[self.offsets[i]:self.offsets[i + 1]], self.closes[self.offsets[i]:self.offsets[i + 1]]
+
+    def total_bars(self):
+        return int(self.offsets[-1])
+
+    def nbytes(self):
+        return int(self.offsets.nbytes + self.dates.nbytes + self.closes.nbytes)
+
+    def slice(self, begin, end):
+        """ Tickers begin to end as a dataset viewing the same arrays """
+        fr, to = self.offsets[begin], self.offsets[end]
+        part = PackedDataset(self.tickers[begin:end], self.offsets[begin:end + 1] - fr, self.dates[fr:to], self.closes[fr:to])
+        part.version = self.version
+        return part
+
+    def publish(self, directory=None):
+        """
+        Write the arrays once to a directory of .npy files, by default under /dev/shm so the pages
+        live in shared memory, and return a PublishedDataset handle that workers attach to by path
+        """
+        if directory is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        path = os.path.join(directory, 'pattern-matcher-{0}-{1}'.format(os.getpid(), uuid.uuid4().hex))
+        os.makedirs(path)
+        np.save(os.path.join(path, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(path, 'dates.npy'), self.dates)
+        np.save(os.path.join(path, 'closes.npy'), self.closes)
+        with open(os.path.join(path, 'tickers.json'), 'w') as f:
+            json.dump(self.tickers, f)
+        logger.info('Published %s tickers to %s', len(self), path)
+        return PublishedDataset(path, self.tickers, owner=True)
+
+class ChannelDataset(PackedDataset):
+    """ A PackedDataset with further columns of the tickers, e.g. volumes, parallel to its closes and sliced along with them """
+
+    def __init__(self, tickers, offsets, dates, closes, channels):
+        PackedDataset.__init__(self, tickers, offsets, dates, closes)
+        self.channels = list(channels)
+
+    @classmethod
+    def of(cls, packed, channels):
+        """ packed with the given columns, views of the same arrays """
+        dataset = cls(packed.tickers, packed.offsets, packed.dates, packed.closes, channels)
+        dataset.version = packed.version
+        return dataset
+
+    def slice(self, begin, end):
+        fr, to = self.offsets[begin], self.offsets[end]
+        part = ChannelDataset(self.tickers[begin:end], self.offsets[begin:end + 1] - fr, self.dates[fr:to], self.closes[fr:to],
+                              [values[fr:to] for values in self.channels])
+        part.version = self.version
+        return part
+
+class PublishedDataset:
+    """
+    Handle to a PackedDataset published on disk. It pickles down to its path, so handing it to a
+    worker costs a few bytes and the worker maps the arrays instead of receiving a copy.
+    The publishing handle removes the files once it is garbage collected
+    """
+
+    def __init__(self, path, tickers=None, owner=False):
+        self.path = path
+        self.tickers = tickers
+        if owner:
+            self._finalizer = weakref.finalize(self, _remove_published, path)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.tickers = None
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def attach(self):
+        """ Memory-map the published arrays, once per process """
+        dataset = _ATTACHED.get(self.path)
+        if dataset is None:
+            # a worker only ever needs the latest version, drop mappings of older ones
+            _ATTACHED.clear()
+            dataset = load_published(self.path)
+            _ATTACHED[self.path] = dataset
+        return dataset
+
+    def detach(self):
+        """ Drop this process' mapping, for callers that copied what they needed """
+        _ATTACHED.pop(self.path, None)
+
+class PackedFrames(Mapping):
+    """ Read-only {ticker: DataFrame[date, close]} view of a PackedDataset, frames are built on access """
+
+    def __init__(self, packed):
+        self.packed = packed
+
+    def __getitem__(self, ticker):
+        if ticker not in self.packed:
+            raise KeyError(ticker)
+        dates, closes = self.packed.series(ticker)
+        # the frames of a compact dataset look like parsed ones
+        return pd.DataFrame({'date': epoch_millis(dates), 'close': float64_closes(closes)}, columns=['date', 'close'])
+
+    def __contains__(self, ticker):
+        return ticker in self.packed
+
+    def __iter__(self):
+        return iter(self.packed.tickers)
+
+    def __len__(self):
+        return len(self.packed)
+
+def load_published(path):
+    """ Memory-map a directory written by PackedDataset.publish """
+    with open(os.path.join(path, 'tickers.json'), 'r') as f:
+        tickers = json.load(f)
+    return PackedDataset(tickers,
+                         np.load(os.path.join(path, 'offsets.npy')),
+                         np.load(os.path.join(path, 'dates.npy'), mmap_mode='r'),
+                         np.load(os.path.join(path, 'closes.npy'), mmap_mode='r'))
+
+def _remove_published(path):
+    try:
+        shutil.rmtree(path)
+    except OSError as e:
+        logger.error('Failed to remove published dataset: %s. Exception follows. %s', path, e)
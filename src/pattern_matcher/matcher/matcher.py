@@ -1,7 +1,10 @@
-from ..measurements.spearmanr import Spearmanr
-from ..measurements.pearson import Pearson
+from ..measurements.spearmanr import Spearmanr, BatchedSpearmanr
+from ..measurements.pearson import Pearson, RollingPearson
 from ..measurements.measurement import Measurement
-from ..loader import csv_loader as loader
+from ..measurements.banded_dtw import BandedDTW, envelope, znormalize_rows
+from ..measurements.spearmanr import sliding_windows
+from ..measurements.combined import CombinedMeasurement
+from ..loader.packed import epoch_millis, float64_closes
 
 import sys, logging
 import numpy as np
@@ -79,4 +82,531 @@ class PearsonMatcher(Matcher):
         stop = time.time() - base
         return ticker, max, (match_close_result, match_date_result, predict_close_result, predict_date_result), (start, stop), dataframe.shape[0]
 
+class VectorizedMatcher(Matcher):
+    """ Scores every window of a ticker in one call to measure_windows instead of a per-window loop """
 
+    # working bytes per window of a chunked pass: the rolling measurements keep about a dozen float64 arrays of the chunk
+    _WINDOW_BYTES = 128
+
+    def __init__(self, measurement, per_ticker=1, exclusion=1.0, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        Matcher.__init__(self)
+        self._measurement = measurement
+        # windows kept per ticker, and the zone around a kept window, as a fraction of the pattern length, where no other may start
+        self.per_ticker = per_ticker
+        self.exclusion = exclusion
+
+    def match(self, base, ticker, dataframe, pattern, days_forward=30, steps=1):
+        start = time.time() - base
+        dates = dataframe.iloc[:, 0].values
+        closes = dataframe.iloc[:, 1].values
+        return self.match_arrays(base, ticker, dates, closes, pattern, days_forward, steps, start)
+
+    def match_arrays(self, base, ticker, dates, closes, pattern, days_forward=30, steps=1, start=None):
+        start = time.time() - base if start is None else start
+        window_size = len(pattern)
+        # same window range as the loop matchers: i + window_size < len - days_forward
+        n_windows = closes.shape[0] - days_forward - window_size
+        if n_windows <= 0:
+            raise ValueError('Not enough data to match ticker: {0}'.format(ticker))
+
+        scores = self._measurement.measure_windows(pattern, closes[:n_windows + window_size - 1])[::steps]
+        max, fr, to = self.best_window(scores, window_size, steps)
+        if fr is None:
+            raise ValueError('No positively correlated window for ticker: {0}'.format(ticker))
+
+        return self.to_result(base, start, ticker, dates, closes, max, fr, to, days_forward)
+
+    def match_shared(self, base, ticker, dataset, pattern, days_forward=30, steps=1):
+        """ Same as match, but reads the ticker from a PublishedDataset mapped into this process """
+        start = time.time() - base
+        dates, closes = dataset.attach().series(ticker)
+        return self.match_arrays(base, ticker, dates, closes, pattern, days_forward, steps, start)
+
+    def match_top(self, base, ticker, dataframe, pattern, days_forward=30, steps=1):
+        """ Same as match, but returns the list of the per_ticker best non-overlapping windows """
+        start = time.time() - base
+        dates = dataframe.iloc[:, 0].values
+        closes = dataframe.iloc[:, 1].values
+        return self.match_arrays_top(base, ticker, dates, closes, pattern, days_forward, steps, start)
+
+    def match_shared_top(self, base, ticker, dataset, pattern, days_forward=30, steps=1):
+        start = time.time() - base
+        dates, closes = dataset.attach().series(ticker)
+        return self.match_arrays_top(base, ticker, dates, closes, pattern, days_forward, steps, start)
+
+    def match_arrays_top(self, base, ticker, dates, closes, pattern, days_forward=30, steps=1, start=None):
+        start = time.time() - base if start is None else start
+        window_size = len(pattern)
+        n_windows = closes.shape[0] - days_forward - window_size
+        if n_windows <= 0:
+            raise ValueError('Not enough data to match ticker: {0}'.format(ticker))
+
+        scores = self._measurement.measure_windows(pattern, closes[:n_windows + window_size - 1])[::steps]
+        starts = np.arange(scores.shape[0]) * steps
+        chosen = self.spread_windows(np.zeros(scores.shape[0], dtype=np.int64), starts, scores, self.per_ticker, self.exclusion_size(window_size), self.per_ticker)
+        return [self.to_result(base, start, ticker, dates, closes, float(scores[k]), int(starts[k]), int(starts[k]) + window_size, days_forward) for k in chosen]
+
+    def match_many(self, base, ticker, dataframe, patterns, days_forward=30, steps=1):
+        """ Results of several patterns of the same length against one ticker, as (pattern position, result) pairs """
+        start = time.time() - base
+        dates = dataframe.iloc[:, 0].values
+        closes = dataframe.iloc[:, 1].values
+        return self.match_arrays_many(base, ticker, dates, closes, patterns, days_forward, steps, start)
+
+    def match_shared_many(self, base, ticker, dataset, patterns, days_forward=30, steps=1):
+        start = time.time() - base
+        dates, closes = dataset.attach().series(ticker)
+        return self.match_arrays_many(base, ticker, dates, closes, patterns, days_forward, steps, start)
+
+    def match_arrays_many(self, base, ticker, dates, closes, patterns, days_forward=30, steps=1, start=None):
+        start = time.time() - base if start is None else start
+        window_size = len(patterns[0])
+        selected = self.select_many(closes, patterns, days_forward, steps)
+        if selected is None:
+            raise ValueError('Not enough data to match ticker: {0}'.format(ticker))
+        return [(p, self.to_result(base, start, ticker, dates, closes, float(score), int(fr), int(fr) + window_size, days_forward))
+                for p, fr, score in zip(*selected)]
+
+    def match_packed_many(self, base, dataset, patterns, days_forward=30, steps=1, top=None):
+        """
+        Results of several patterns of the same length against a PackedDataset, as (pattern position,
+        result) pairs with the top results of each pattern. The universe is walked ticker by ticker and
+        every series is scored against all patterns at once while it is in cache
+        """
+        start = time.time() - base
+        window_size = len(patterns[0])
+        found = []
+        for i in range(len(dataset)):
+            fr = dataset.offsets[i]
+            selected = self.select_many(dataset.closes[fr:dataset.offsets[i + 1]], patterns, days_forward, steps)
+            if selected is not None:
+                positions, starts, scores = selected
+                found.append((positions, np.full(positions.shape[0], i), starts + fr, scores))
+        if not found:
+            return []
+
+        positions, tickers, starts, scores = (np.concatenate(column) for column in zip(*found))
+        pairs = []
+        for p in range(len(patterns)):
+            # descending score, earlier ticker and start first on ties like match_packed
+            chosen = np.flatnonzero(positions == p)
+            chosen = chosen[np.lexsort((starts[chosen], -scores[chosen]))][:top]
+            results = self.ordered_results(base, start, dataset, tickers[chosen], starts[chosen], scores[chosen], window_size, days_forward)
+            pairs.extend((p, result) for result in results)
+        return pairs
+
+    def select_many(self, closes, patterns, days_forward, steps):
+        """
+        (pattern positions, window starts, scores) of the per_ticker best windows of every pattern in one
+        series, None when the series is too short
+        """
+        window_size = len(patterns[0])
+        n_windows = closes.shape[0] - days_forward - window_size
+        if n_windows <= 0:
+            return None
+        scores = self._measurement.measure_windows_many(patterns, closes[:n_windows + window_size - 1])[::steps]
+        scores = np.where(np.isnan(scores), -np.inf, scores)
+        starts = np.arange(scores.shape[0]) * steps
+
+        if self.per_ticker > 1:
+            exclusion = self.exclusion_size(window_size)
+            chosen = [(p, k) for p in range(scores.shape[1])
+                      for k in self.spread_windows(np.zeros(scores.shape[0], dtype=np.int64), starts, scores[:, p], self.per_ticker, exclusion, self.per_ticker)]
+            positions = np.array([p for p, _ in chosen], dtype=np.int64)
+            best = np.array([k for _, k in chosen], dtype=np.int64)
+        else:
+            # argmax keeps the first best window like best_window
+            positions = np.arange(scores.shape[1])
+            best = np.argmax(scores, axis=0)
+        best_scores = scores[best, positions]
+        found = best_scores > sys.float_info.min
+        return positions[found], starts[best[found]], best_scores[found]
+
+    def match_packed(self, base, dataset, pattern, days_forward=30, steps=1, top=None):
+        """
+        Score every window of every ticker of a PackedDataset in one measure_windows call.
+        Windows crossing a ticker boundary or reaching into the days_forward tail are masked out,
+        then the best window of each ticker is reduced with reduceat. Only the top best tickers
+        are turned into result tuples when top is given
+        """
+        start = time.time() - base
+        scores = self._measurement.measure_windows(pattern, dataset.closes)
+        return self.rank_packed(base, start, dataset, scores, len(pattern), days_forward, steps, top)
+
+    def match_channels(self, base, dataset, patterns, weights, days_forward=30, steps=1, top=None):
+        """
+        match_packed over several channels of a ChannelDataset, e.g. closes and volumes, each with NaN
+        where a bar has no value. Every ticker is scored on its own against the pattern of each channel,
+        a window's similarity is the weighted mean of its channel similarities and windows missing
+        a value in any channel are left out
+        """
+        start = time.time() - base
+        window_size = len(patterns[0])
+        offsets = dataset.offsets
+        total = np.full(max(dataset.closes.shape[0] - window_size + 1, 0), np.nan)
+        for i in range(len(dataset)):
+            fr, to = offsets[i], offsets[i + 1]
+            if to - fr < window_size:
+                continue
+            scores = np.zeros(to - fr - window_size + 1)
+            for values, pattern, weight in zip(dataset.channels, patterns, weights):
+                values = np.asarray(values[fr:to], dtype=np.float64)
+                missing = np.isnan(values)
+                if missing.any():
+                    # a NaN would spread through the running sums of the rolling measurements
+                    counts = np.concatenate(([0], np.cumsum(missing)))
+                    channel = self._measurement.measure_windows(pattern, np.where(missing, 0., values))
+                    channel[counts[window_size:] - counts[:-window_size] > 0] = np.nan
+                else:
+                    channel = self._measurement.measure_windows(pattern, values)
+                scores += weight * channel
+            total[fr:to - window_size + 1] = scores
+        return self.rank_packed(base, start, dataset, total / sum(weights), window_size, days_forward, steps, top)
+
+    def match_chunked(self, base, dataset, pattern, days_forward=30, steps=1, top=None, memory=64 * 2 ** 20):
+        """
+        match_packed in bounded memory for histories too long to score at once, e.g. minute bars read
+        from a memory-mapped column store. The packed closes are scored in chunks of windows that
+        overlap by window_size - 1 bars, sized so a pass's working arrays stay within memory bytes.
+        Only windows that can still reach the top are kept between chunks: the best window of every
+        ticker is always taken, so a window scoring below the top-th best ticker so far never is
+        """
+        start = time.time() - base
+        window_size = len(pattern)
+        offsets = dataset.offsets
+        limits = offsets[1:] - days_forward - window_size
+        n_windows = dataset.closes.shape[0] - window_size + 1
+        chunk = max(window_size, int(memory // self._WINDOW_BYTES))
+
+        best = np.full(len(dataset), -np.inf)
+        kept_tickers, kept_starts, kept_scores = [], [], []
+        threshold = sys.float_info.min
+        for begin in range(0, max(n_windows, 0), chunk):
+            end = min(begin + chunk, n_windows)
+            scores = self.measure_chunk(pattern, dataset.closes[begin:end + window_size - 1], memory)
+            starts = np.arange(begin, end)
+            tickers = np.searchsorted(offsets, starts, side='right') - 1
+            valid = (starts < limits[tickers]) & ((starts - offsets[tickers]) % steps == 0)
+            scores = np.where(valid & ~np.isnan(scores), scores, -np.inf)
+            # starts ascend, so each ticker of the chunk is one segment
+            segments = np.concatenate(([0], np.flatnonzero(np.diff(tickers)) + 1))
+            best[tickers[segments]] = np.maximum(best[tickers[segments]], np.maximum.reduceat(scores, segments))
+            if top is not None and np.count_nonzero(best > sys.float_info.min) >= top:
+                threshold = max(threshold, np.partition(best, best.shape[0] - top)[best.shape[0] - top])
+
+            kept = scores >= threshold
+            kept_tickers.append(tickers[kept])
+            kept_starts.append(starts[kept])
+            kept_scores.append(scores[kept])
+            if sum(part.shape[0] for part in kept_scores) > chunk:
+                # the threshold only rises, drop what fell below it since
+                tickers, starts, scores = (np.concatenate(column) for column in (kept_tickers, kept_starts, kept_scores))
+                kept = scores >= threshold
+                kept_tickers, kept_starts, kept_scores = [tickers[kept]], [starts[kept]], [scores[kept]]
+        if not kept_scores:
+            return []
+
+        tickers, starts, scores = (np.concatenate(column) for column in (kept_tickers, kept_starts, kept_scores))
+        if self.per_ticker > 1:
+            chosen = self.spread_windows(tickers, starts, scores, self.per_ticker, self.exclusion_size(window_size), top)
+            return self.ordered_results(base, start, dataset, tickers[chosen], starts[chosen], scores[chosen], window_size, days_forward)
+
+        # the first best window of each ticker, tickers in packed order like match_packed
+        order = np.lexsort((starts, -scores, tickers))
+        first = order[np.concatenate(([True], tickers[order][1:] != tickers[order][:-1]))]
+        return self.ranked_results(base, start, dataset, tickers[first], starts[first], scores[first], window_size, days_forward, top)
+
+    def measure_chunk(self, pattern, series, memory):
+        """ measure_windows of a chunk of match_chunked, within memory bytes """
+        return self._measurement.measure_windows(pattern, series)
+
+    def rank_packed(self, base, start, dataset, scores, window_size, days_forward=30, steps=1, top=None):
+        """ Result tuples of the best windows of a PackedDataset given the score of every packed window start """
+        offsets = dataset.offsets
+        # last valid start of each ticker, same rule as match_arrays
+        limits = offsets[1:] - days_forward - window_size
+        eligible = np.flatnonzero(limits > offsets[:-1])
+        if eligible.shape[0] == 0:
+            return []
+
+        window_tickers = np.repeat(np.arange(len(dataset)), np.diff(offsets))[:scores.shape[0]]
+        local_starts = np.arange(scores.shape[0]) - offsets[window_tickers]
+        valid = (np.arange(scores.shape[0]) < limits[window_tickers]) & (local_starts % steps == 0)
+        scores = np.where(valid & ~np.isnan(scores), scores, -np.inf)
+        if self.per_ticker > 1:
+            chosen = self.spread_windows(window_tickers, np.arange(scores.shape[0]), scores, self.per_ticker, self.exclusion_size(window_size), top)
+            return self.ordered_results(base, start, dataset, window_tickers[chosen], chosen, scores[chosen], window_size, days_forward)
+
+        # every eligible ticker has its first window inside scores, ineligible ones are all -inf
+        segment_starts = offsets[eligible]
+        best_scores = np.maximum.reduceat(scores, segment_starts)
+        is_best = scores == np.repeat(best_scores, np.diff(np.append(segment_starts, scores.shape[0])))
+        best_starts = np.minimum.reduceat(np.where(is_best, np.arange(scores.shape[0]), scores.shape[0]), segment_starts)
+
+        return self.ranked_results(base, start, dataset, eligible, best_starts, best_scores, window_size, days_forward, top)
+
+    def match_candidates(self, base, dataset, starts, pattern, days_forward=30, top=None):
+        """
+        Score only the given window starts of a PackedDataset, typically candidates from a WindowIndex,
+        and keep the best of them per ticker, earliest start first on ties like match_packed
+        """
+        start = time.time() - base
+        window_size = len(pattern)
+        offsets = dataset.offsets
+        tickers = np.searchsorted(offsets, starts, side='right') - 1
+        valid = starts < offsets[tickers + 1] - days_forward - window_size
+        starts, tickers = starts[valid], tickers[valid]
+        if starts.shape[0] == 0:
+            return []
+
+        windows = np.asarray(dataset.closes)[starts[:, np.newaxis] + np.arange(window_size)]
+        scores = self._measurement.measure_rows(pattern, windows)
+        scores = np.where(np.isnan(scores), -np.inf, scores)
+        if self.per_ticker > 1:
+            chosen = self.spread_windows(tickers, starts, scores, self.per_ticker, self.exclusion_size(window_size), top)
+            return self.ordered_results(base, start, dataset, tickers[chosen], starts[chosen], scores[chosen], window_size, days_forward)
+
+        order = np.lexsort((starts, -scores, tickers))
+        first = order[np.concatenate(([True], tickers[order][1:] != tickers[order][:-1]))]
+        return self.ranked_results(base, start, dataset, tickers[first], starts[first], scores[first], window_size, days_forward, top)
+
+    def ranked_results(self, base, start, dataset, tickers, best_starts, best_scores, window_size, days_forward, top=None):
+        """ Result tuples of the best window of each ticker position, by descending score, top of them when given """
+        found = best_scores > sys.float_info.min
+        tickers, best_scores, best_starts = tickers[found], best_scores[found], best_starts[found]
+        order = np.argsort(-best_scores, kind='mergesort')
+        if top is not None:
+            order = order[:top]
+        return self.ordered_results(base, start, dataset, tickers[order], best_starts[order], best_scores[order], window_size, days_forward)
+
+    def ordered_results(self, base, start, dataset, tickers, starts, scores, window_size, days_forward):
+        """ Result tuples of the given packed window starts, in the given order """
+        results = []
+        for i, packed_start, score in zip(tickers, starts, scores):
+            dates, closes = dataset.series(dataset.tickers[i])
+            fr = int(packed_start - dataset.offsets[i])
+            results.append(self.to_result(base, start, dataset.tickers[i], dates, closes, float(score), fr, fr + window_size, days_forward))
+        return results
+
+    def exclusion_size(self, window_size):
+        return max(1, int(round(self.exclusion * window_size)))
+
+    @staticmethod
+    def spread_windows(tickers, starts, scores, per_ticker, exclusion, top=None):
+        """
+        Positions of the best windows by descending score, earliest start first on ties, at most per_ticker
+        of each ticker and none starting within exclusion of a window already taken from its ticker.
+        Visiting windows in global score order makes the first top of them the global top. With top, only
+        the best per_ticker * top windows are sorted and visited, more when their exclusion zones and
+        per-ticker limits turned too many of them away
+        """
+        candidates = np.flatnonzero(scores > sys.float_info.min)
+        limit = candidates.shape[0] if top is None else max(per_ticker * top, 1)
+        while True:
+            pool = candidates
+            if limit < candidates.shape[0]:
+                # every window scoring at least the limit-th best, ties included so the order is that of a full sort
+                kth = np.partition(scores[candidates], candidates.shape[0] - limit)[candidates.shape[0] - limit]
+                pool = candidates[scores[candidates] >= kth]
+            order = pool[np.lexsort((starts[pool], -scores[pool]))]
+            chosen, taken = [], dict()
+            for k in order:
+                picked = taken.setdefault(tickers[k], [])
+                if len(picked) >= per_ticker or any(abs(starts[k] - s) < exclusion for s in picked):
+                    continue
+                picked.append(starts[k])
+                chosen.append(k)
+                if top is not None and len(chosen) == top:
+                    break
+            if top is None or len(chosen) == top or pool.shape[0] == candidates.shape[0]:
+                return np.array(chosen, dtype=np.int64)
+            limit *= 4
+
+    @staticmethod
+    def to_result(base, start, ticker, dates, closes, max, fr, to, days_forward):
+        # copies, a view would keep the whole dataset of a replaced snapshot alive in the result cache.
+        # Compact datasets answer in the representation of parsed data
+        match_close_result = float64_closes(closes[fr:to].copy())
+        match_date_result = epoch_millis(dates[fr:to].copy())
+        predict_close_result = float64_closes(closes[to:to + days_forward].copy())
+        predict_date_result = epoch_millis(dates[to:to + days_forward].copy())
+
+        stop = time.time() - base
+        return ticker, max, (match_close_result, match_date_result, predict_close_result, predict_date_result), (start, stop), closes.shape[0]
+
+    @staticmethod
+    def best_window(scores, window_size, steps=1):
+        """ First highest score above sys.float_info.min, mirroring the strict > in the loop matchers """
+        scores = np.where(np.isnan(scores), -np.inf, scores)
+        if scores.shape[0] == 0:
+            return sys.float_info.min, None, None
+        best = int(np.argmax(scores))
+        if not scores[best] > sys.float_info.min:
+            return sys.float_info.min, None, None
+        fr = best * steps
+        return float(scores[best]), fr, fr + window_size
+
+class VectorizedSpearmanMatcher(VectorizedMatcher):
+
+    def __init__(self, chunk_size=4096, per_ticker=1, exclusion=1.0, logger=None):
+        VectorizedMatcher.__init__(self, Measurement(BatchedSpearmanr(chunk_size)), per_ticker, exclusion, logger)
+
+class VectorizedPearsonMatcher(VectorizedMatcher):
+
+    def __init__(self, chunk_size=4096, per_ticker=1, exclusion=1.0, logger=None):
+        VectorizedMatcher.__init__(self, Measurement(RollingPearson(chunk_size)), per_ticker, exclusion, logger)
+
+class CombinedMatcher(VectorizedMatcher):
+    """ Ranks windows by the mean similarity of several measurements computed in the same sweep """
+
+    def __init__(self, methods, chunk_size=4096, per_ticker=1, exclusion=1.0, logger=None):
+        VectorizedMatcher.__init__(self, Measurement(CombinedMeasurement(methods, chunk_size)), per_ticker, exclusion, logger)
+
+class DTWMatcher(VectorizedMatcher):
+    """
+    Elastic matching with a Sakoe-Chiba banded DTW. Lower bounds of all windows are computed
+    vectorized, windows are then verified in batches by increasing bound, and a batch stops as soon
+    as its bound exceeds the k-th best ticker distance. Each DTW abandons once it can no longer beat
+    its ticker's best or the k-th best. Similarity is reported as 1 / (1 + distance)
+    """
+
+    # working bytes per bar of a window verified by DTW: its z-normalized copy, the DP rows and their temporaries
+    _CELL_BYTES = 96
+
+    def __init__(self, window=0.1, batch_size=256, per_ticker=1, exclusion=1.0, logger=None):
+        VectorizedMatcher.__init__(self, Measurement(BandedDTW(window)), per_ticker, exclusion, logger)
+        self.batch_size = batch_size
+
+    def match_arrays(self, base, ticker, dates, closes, pattern, days_forward=30, steps=1, start=None):
+        start = time.time() - base if start is None else start
+        window_size = len(pattern)
+        n_windows = closes.shape[0] - days_forward - window_size
+        if n_windows <= 0:
+            raise ValueError('Not enough data to match ticker: {0}'.format(ticker))
+
+        starts = np.arange(0, n_windows, steps)
+        _, best_starts, best_distances = self.search(closes, starts, np.zeros(starts.shape[0], dtype=np.int64), pattern, 1, 1)
+        fr = int(best_starts[0])
+        return self.to_result(base, start, ticker, dates, closes, float(BandedDTW.similarity(best_distances[0])), fr, fr + window_size, days_forward)
+
+    def match_packed(self, base, dataset, pattern, days_forward=30, steps=1, top=None):
+        if self.per_ticker > 1:
+            # the pruning bounds only the best window of each ticker, several need every distance
+            return VectorizedMatcher.match_packed(self, base, dataset, pattern, days_forward, steps, top)
+        start = time.time() - base
+        window_size = len(pattern)
+        offsets = dataset.offsets
+        counts = np.maximum(offsets[1:] - offsets[:-1] - days_forward - window_size, 0)
+        counts = (counts + steps - 1) // steps
+        tickers = np.repeat(np.arange(len(dataset)), counts)
+        starts = offsets[tickers] + steps * (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+        return self.ranked_search(base, start, dataset, starts, tickers, pattern, days_forward, top)
+
+    def match_chunked(self, base, dataset, pattern, days_forward=30, steps=1, top=None, memory=64 * 2 ** 20):
+        """
+        match_packed within memory bytes. Several windows per ticker are scored chunk by chunk like the
+        other measurements, one per ticker runs the pruned search over a chunk of windows at a time,
+        carrying every ticker's best distance on so later chunks are pruned as hard as one search would be
+        """
+        if self.per_ticker > 1:
+            return VectorizedMatcher.match_chunked(self, base, dataset, pattern, days_forward, steps, top, memory)
+        start = time.time() - base
+        window_size = len(pattern)
+        offsets = dataset.offsets
+        limits = offsets[1:] - days_forward - window_size
+        n_windows = dataset.closes.shape[0] - window_size + 1
+        chunk = max(window_size, int(memory // self._WINDOW_BYTES))
+
+        best = np.full(len(dataset), np.inf)
+        best_starts = np.full(len(dataset), -1, dtype=np.int64)
+        for begin in range(0, max(n_windows, 0), chunk):
+            starts = np.arange(begin, min(begin + chunk, n_windows))
+            tickers = np.searchsorted(offsets, starts, side='right') - 1
+            valid = (starts < limits[tickers]) & ((starts - offsets[tickers]) % steps == 0)
+            if valid.any():
+                self.search(dataset.closes, starts[valid], tickers[valid], pattern, len(dataset), top, (best, best_starts), self.verify_rows(window_size, memory))
+        ids = np.flatnonzero(np.isfinite(best))
+        if ids.shape[0] == 0:
+            return []
+        return self.ranked_results(base, start, dataset, ids, best_starts[ids], BandedDTW.similarity(best[ids]), window_size, days_forward, top)
+
+    def measure_chunk(self, pattern, series, memory):
+        series = np.asarray(series, dtype=np.float64)
+        if series.shape[0] < len(pattern):
+            return np.empty(0, dtype=np.float64)
+        return self._measurement.method.measure_rows(pattern, sliding_windows(series, len(pattern)), self.verify_rows(len(pattern), memory))
+
+    def verify_rows(self, window_size, memory):
+        """ Windows z-normalized and verified at once, so that a quarter of memory bytes holds them """
+        return max(1, int(memory // (4 * self._CELL_BYTES * window_size)))
+
+    def match_candidates(self, base, dataset, starts, pattern, days_forward=30, top=None):
+        if self.per_ticker > 1:
+            return VectorizedMatcher.match_candidates(self, base, dataset, starts, pattern, days_forward, top)
+        start = time.time() - base
+        offsets = dataset.offsets
+        tickers = np.searchsorted(offsets, starts, side='right') - 1
+        valid = starts < offsets[tickers + 1] - days_forward - len(pattern)
+        return self.ranked_search(base, start, dataset, starts[valid], tickers[valid], pattern, days_forward, top)
+
+    def ranked_search(self, base, start, dataset, starts, tickers, pattern, days_forward, top):
+        if starts.shape[0] == 0:
+            return []
+        ids, best_starts, best_distances = self.search(dataset.closes, starts, tickers, pattern, len(dataset), top)
+        return self.ranked_results(base, start, dataset, ids, best_starts, BandedDTW.similarity(best_distances), len(pattern), days_forward, top)
+
+    def search(self, closes, starts, tickers, pattern, n_tickers, top=None, found=None, rows=None):
+        """
+        Best (lowest distance, then earliest) window start of each ticker among starts, exact for the
+        top tickers. Returns (ticker ids, best starts, best distances) of every ticker that was verified.
+        found, the (best distances, best starts) arrays of every ticker from a search over other starts,
+        is updated in place and prunes this one. rows caps the windows z-normalized at once
+        """
+        dtw = self._measurement.method
+        rows = rows or dtw.chunk_size
+        batch_size = min(self.batch_size, rows)
+        window_size = len(pattern)
+        offsets = np.arange(window_size)
+        query = znormalize_rows(pattern)
+        upper, lower = envelope(query, dtw.radius(window_size))
+
+        bounds = np.empty(starts.shape[0], dtype=np.float64)
+        for begin in range(0, starts.shape[0], rows):
+            windows = znormalize_rows(closes[starts[begin:begin + rows, np.newaxis] + offsets])
+            bounds[begin:begin + windows.shape[0]] = dtw.lower_bounds(query, upper, lower, windows)
+        order = np.argsort(bounds, kind='mergesort')
+
+        top = n_tickers if top is None else min(top, n_tickers)
+        if found is None:
+            best = np.full(n_tickers, np.inf)
+            best_starts = np.full(n_tickers, -1, dtype=np.int64)
+        else:
+            best, best_starts = found
+        kth = self.kth(best, top)
+        for begin in range(0, order.shape[0], batch_size):
+            batch = order[begin:begin + batch_size]
+            if bounds[batch[0]] > kth:
+                break
+            limits = np.minimum(best[tickers[batch]], kth)
+            promising = bounds[batch] <= limits
+            batch, limits = batch[promising], limits[promising]
+            if batch.shape[0] == 0:
+                continue
+
+            windows = znormalize_rows(closes[starts[batch, np.newaxis] + offsets])
+            distances = dtw.distances(query, windows, limits)
+            for k in np.flatnonzero(np.isfinite(distances)):
+                t, d, s = tickers[batch[k]], distances[k], starts[batch[k]]
+                if d < best[t] or (d == best[t] and s < best_starts[t]):
+                    best[t], best_starts[t] = d, s
+            kth = self.kth(best, top)
+
+        ids = np.flatnonzero(np.isfinite(best))
+        return ids, best_starts[ids], best[ids]
+
+    @staticmethod
+    def kth(best, top):
+        """ The top-th lowest of the finite best distances, inf while fewer were found """
+        found = best[np.isfinite(best)]
+        return np.partition(found, top - 1)[top - 1] if found.shape[0] >= top else np.inf
@@ -0,0 +1,129 @@
+import logging
+import numpy as np
+from ..measurements.pearson import RollingPearson
+from ..loader.packed import ticker_prefix_sums, carried_bars
+from .matcher import VectorizedMatcher
+
+def ranges(begins, ends):
+    """ Concatenation of arange(begins[k], ends[k]) over k, empty ranges skipped """
+    counts = np.maximum(ends - begins, 0)
+    if counts.sum() == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.repeat(begins, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+
+class ResolutionPyramid:
+    """
+    Downsampled views of a PackedDataset, e.g. weekly and monthly means, for coarse-to-fine search.
+    A level keeps the mean of the factor bars starting at every bar, so the downsampled window at
+    any start is every factor-th of them and no phase of the pattern is lost. The pattern's block
+    means are scored by correlation against every start at the coarsest level, the best starts are
+    rescored at the next finer level around them, and the bars around the survivors of the finest
+    level are handed back as candidate starts for exact verification at full resolution. The search
+    is approximate: a match whose coarse shape ranks outside the kept regions is missed, regions and
+    per_ticker trade recall for speed
+    """
+
+    # blocks a downsampled pattern needs for its level to be used
+    _MIN_LENGTH = 4
+    # scored starts considered for the survivors of a level, as a multiple of regions
+    _POOL = 10
+
+    def __init__(self, factors=(21, 5), regions=2000, per_ticker=10, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.factors = sorted(set(int(factor) for factor in factors), reverse=True)
+        self.regions = regions
+        self.per_ticker = per_ticker
+        # {factor: float32 mean of the factor bars starting at each bar}
+        self.levels = dict()
+        self.offsets = np.zeros(1, dtype=np.int64)
+        # end of the ticker of every bar
+        self.ends = np.zeros(0, dtype=np.int64)
+        self._pearson = RollingPearson()
+
+    def build(self, dataset):
+        """ Downsample every ticker of the dataset at every factor """
+        self.offsets = np.asarray(dataset.offsets, dtype=np.int64)
+        self.ends = np.repeat(self.offsets[1:], np.diff(self.offsets))
+        self.levels = self.downsample(dataset)
+        self.logger.info('Built resolution pyramid of factors %s over %s bars', self.factors, int(self.offsets[-1]))
+        return self
+
+    def update(self, dataset, previous, pyramid, changed):
+        """
+        build() of dataset from pyramid, the pyramid of the previous dataset, after the tickers in changed
+        were re-read. Levels are per ticker, the others are copied over
+        """
+        kept, fresh = carried_bars(previous, dataset, changed)
+        self.offsets = np.asarray(dataset.offsets, dtype=np.int64)
+        self.ends = np.repeat(self.offsets[1:], np.diff(self.offsets))
+        self.levels = {factor: np.zeros(int(self.offsets[-1]), dtype=np.float32) for factor in self.factors}
+        for factor in self.factors:
+            for i, j in kept:
+                self.levels[factor][self.offsets[i]:self.offsets[i + 1]] = pyramid.levels[factor][previous.offsets[j]:previous.offsets[j + 1]]
+        for i in fresh:
+            levels = self.downsample(dataset.slice(i, i + 1))
+            for factor in self.factors:
+                self.levels[factor][self.offsets[i]:self.offsets[i + 1]] = levels[factor]
+        self.logger.info('Downsampled %s changed tickers of factors %s', len(fresh), self.factors)
+        return self
+
+    def downsample(self, dataset):
+        """ {factor: float32 mean of the factor bars starting at each bar} of the dataset """
+        offsets = np.asarray(dataset.offsets, dtype=np.int64)
+        n = int(offsets[-1])
+        ends = np.repeat(offsets[1:], np.diff(offsets))
+        # levels hold each ticker centered on its own mean, a correlation does not see the shift and the
+        # float32 means keep the resolution of cheap tickers that a universe-wide center would take
+        prefix, _ = ticker_prefix_sums(offsets, dataset.closes)
+        positions = np.arange(n) + np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        levels = dict()
+        for factor in self.factors:
+            inside = np.arange(n) + factor <= ends
+            means = np.zeros(n, dtype=np.float32)
+            # the last bars of a ticker have no full block, they stay at the mean and are never scored
+            means[inside] = (prefix[positions[inside] + factor] - prefix[positions[inside]]) / factor
+            levels[factor] = means
+        return levels
+
+    def covers(self, window_size):
+        """ Whether patterns of window_size are long enough for at least one level """
+        return any(window_size // factor >= self._MIN_LENGTH for factor in self.levels)
+
+    def candidates(self, pattern):
+        """ Window starts of the dataset worth verifying exactly, the pattern has to be covered """
+        pattern = np.asarray(pattern, dtype=np.float64)
+        window_size = pattern.shape[0]
+        factors = [factor for factor in self.factors if window_size // factor >= self._MIN_LENGTH]
+        n = int(self.offsets[-1])
+
+        survivors = None
+        for factor in factors:
+            length = window_size // factor
+            query = pattern[:length * factor].reshape(length, factor).mean(axis=1)
+            means = self.levels[factor]
+            if survivors is None:
+                # every start, one rolling pass per phase of the factor
+                starts = np.arange(n)
+                scores = np.full(n, np.nan)
+                for phase in range(min(factor, n)):
+                    phase_scores = self._pearson.measure_windows(query, means[phase::factor])
+                    scores[phase:phase + factor * phase_scores.shape[0]:factor] = phase_scores
+            else:
+                # the starts around the survivors of the coarser level
+                starts = np.unique(ranges(survivors[0], survivors[1]))
+                scores = self._pearson.measure_rows(query, means[np.minimum(starts[:, np.newaxis] + factor * np.arange(length), n - 1)])
+            # the downsampled window has to stay inside its ticker
+            scores = np.where(starts + length * factor <= self.ends[starts], scores, np.nan)
+            scores = np.where(np.isnan(scores), -np.inf, scores)
+
+            # the best starts, a few per ticker and a block apart, survive to the next level
+            pool = np.arange(scores.shape[0])
+            if pool.shape[0] > self._POOL * self.regions:
+                pool = np.argpartition(-scores, self._POOL * self.regions)[:self._POOL * self.regions]
+            tickers = np.searchsorted(self.offsets, starts[pool], side='right') - 1
+            chosen = VectorizedMatcher.spread_windows(tickers, starts[pool], scores[pool], self.per_ticker, factor, self.regions)
+            if chosen.shape[0] == 0:
+                return np.empty(0, dtype=np.int64)
+            best, best_tickers = starts[pool[chosen]], tickers[chosen]
+            survivors = (np.maximum(best - factor + 1, self.offsets[best_tickers]), np.minimum(best + factor, self.offsets[best_tickers + 1]))
+        return np.unique(ranges(survivors[0], survivors[1]))
@@ -0,0 +1,121 @@
+import logging
+import numpy as np
+import scipy.stats as stats
+from ..loader.packed import ticker_prefix_sums, carried_bars
+
+class WindowIndex:
+    """
+    SAX index over the z-normalized windows of one length of a PackedDataset.
+    Each window is reduced to the piecewise aggregate approximation (PAA) of its z-normalized
+    values and quantized into a word of `segments` symbols from an `alphabet`-letter Gaussian
+    alphabet. Window starts are grouped by word, and a query visits the words closest to the
+    pattern's PAA first until it has collected enough candidates for exact verification
+    """
+
+    # windows processed at once while building, bounds the PAA scratch memory
+    _BUILD_CHUNK = 1 << 18
+
+    def __init__(self, window_size, segments=8, alphabet=4, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.window_size = window_size
+        self.segments = min(segments, window_size)
+        self.alphabet = alphabet
+        self.bounds = np.linspace(0, window_size, self.segments + 1).astype(np.int64)
+        self.breakpoints = stats.norm.ppf(np.arange(1, alphabet) / float(alphabet))
+        self.starts = np.empty(0, dtype=np.int64)
+        self.words = np.empty((0, self.segments), dtype=np.int8)
+        self.buckets = np.zeros(1, dtype=np.int64)
+
+    def paa(self, prefix, prefix_sq, starts):
+        """ PAA of the z-normalized windows at starts, given positions in prefix sums of the series and its squares """
+        w = self.window_size
+        sums = prefix[starts + w] - prefix[starts]
+        sums_sq = prefix_sq[starts + w] - prefix_sq[starts]
+        means = sums / w
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stds = np.sqrt(np.maximum(sums_sq / w - means * means, 0.))
+            seg_lengths = np.diff(self.bounds)
+            seg_means = (prefix[starts[:, None] + self.bounds[1:]] - prefix[starts[:, None] + self.bounds[:-1]]) / seg_lengths
+            paa = (seg_means - means[:, None]) / stds[:, None]
+        # flat windows sit in the middle of the alphabet
+        return np.where(np.isfinite(paa), paa, 0.)
+
+    def build(self, dataset):
+        """ Index every window of the given length that stays inside one ticker """
+        return self.assemble(*self.encode(dataset))
+
+    def update(self, dataset, previous, index, changed):
+        """
+        build() of dataset from index, the index of the previous dataset, after the tickers in changed
+        were re-read. A window's word only depends on its own ticker, the others keep theirs
+        """
+        kept, fresh = carried_bars(previous, dataset, changed)
+        carried = np.zeros(len(previous), dtype=bool)
+        shifts = np.zeros(len(previous), dtype=np.int64)
+        for i, j in kept:
+            carried[j] = True
+            shifts[j] = dataset.offsets[i] - previous.offsets[j]
+        tickers = np.searchsorted(previous.offsets, index.starts, side='right') - 1
+        keep = carried[tickers]
+        starts = [index.starts[keep] + shifts[tickers[keep]]]
+        words = [np.repeat(index.words, np.diff(index.buckets), axis=0)[keep]]
+        for i in fresh:
+            fresh_starts, fresh_words = self.encode(dataset.slice(i, i + 1))
+            starts.append(fresh_starts + dataset.offsets[i])
+            words.append(fresh_words)
+        self.logger.info('Encoded windows of %s changed tickers', len(fresh))
+        return self.assemble(np.concatenate(starts), np.concatenate(words))
+
+    def encode(self, dataset):
+        """ (starts, words) of every window of the dataset, in order of their starts """
+        w = self.window_size
+        # per ticker, sums over the whole universe would cancel the cheap tickers' windows
+        prefix, prefix_sq = ticker_prefix_sums(dataset.offsets, dataset.closes)
+
+        lengths = np.diff(dataset.offsets)
+        counts = np.maximum(lengths - w + 1, 0)
+        starts = np.repeat(dataset.offsets[:-1], counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+        # ticker i's sums are shifted by i
+        positions = starts + np.repeat(np.arange(len(dataset)), counts)
+
+        words = np.empty((starts.shape[0], self.segments), dtype=np.int8)
+        for begin in range(0, starts.shape[0], self._BUILD_CHUNK):
+            chunk = positions[begin:begin + self._BUILD_CHUNK]
+            symbols = np.searchsorted(self.breakpoints, self.paa(prefix, prefix_sq, chunk)).astype(np.int8)
+            words[begin:begin + chunk.shape[0]] = symbols
+        return starts, words
+
+    def assemble(self, starts, words):
+        """ Group window starts by word, starts ascending within a word """
+        codes = np.empty(starts.shape[0], dtype=np.int64)
+        powers = self.alphabet ** np.arange(self.segments, dtype=np.int64)
+        for begin in range(0, starts.shape[0], self._BUILD_CHUNK):
+            codes[begin:begin + self._BUILD_CHUNK] = words[begin:begin + self._BUILD_CHUNK].astype(np.int64).dot(powers)
+        order = np.lexsort((starts, codes))
+        codes = codes[order]
+        self.starts = starts[order]
+        first = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+        self.words = words[order][first]
+        self.buckets = np.append(first, codes.shape[0])
+        self.logger.info('Indexed %s windows of length %s into %s words', self.starts.shape[0], self.window_size, self.words.shape[0])
+        return self
+
+    def candidates(self, pattern, limit):
+        """ Window starts of the buckets closest to the pattern, at least limit of them when available """
+        pattern = np.asarray(pattern, dtype=np.float64)
+        prefix = np.concatenate(([0.], np.cumsum(pattern - pattern.mean())))
+        prefix_sq = np.concatenate(([0.], np.cumsum((pattern - pattern.mean()) ** 2)))
+        query = self.paa(prefix, prefix_sq, np.zeros(1, dtype=np.int64))[0]
+
+        # SAX MINDIST from the query's PAA to the cell of every word
+        edges = np.concatenate(([-np.inf], self.breakpoints, [np.inf]))
+        low, high = edges[self.words], edges[self.words.astype(np.int64) + 1]
+        gaps = np.maximum(low - query, 0.) + np.maximum(query - high, 0.)
+        distances = (gaps * gaps).dot(np.diff(self.bounds))
+
+        order = np.argsort(distances, kind='mergesort')
+        sizes = np.diff(self.buckets)[order]
+        taken = order[:np.searchsorted(np.cumsum(sizes), limit) + 1]
+        if taken.shape[0] == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self.starts[self.buckets[k]:self.buckets[k + 1]] for k in taken])
@@ -0,0 +1,120 @@
+import logging
+import numpy as np
+from .spearmanr import sliding_windows
+
+def znormalize_rows(windows):
+    """ z-normalize every row, flat rows become all zeros """
+    windows = np.asarray(windows, dtype=np.float64)
+    means = windows.mean(axis=-1, keepdims=True)
+    stds = windows.std(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized = (windows - means) / stds
+    return np.where(stds > 0, normalized, 0.)
+
+def envelope(query, radius):
+    """ Upper and lower envelope of query over a Sakoe-Chiba band of the given radius """
+    padded = np.concatenate((np.full(radius, np.nan), query, np.full(radius, np.nan)))
+    spans = np.lib.stride_tricks.as_strided(padded, shape=(query.shape[0], 2 * radius + 1), strides=(padded.strides[0], padded.strides[0]))
+    return np.nanmax(spans, axis=1), np.nanmin(spans, axis=1)
+
+class BandedDTW:
+    """
+    Dynamic time warping restricted to a Sakoe-Chiba band, on z-normalized series with a squared
+    point cost. Provides the cascaded LB_Kim / LB_Keogh lower bounds over many windows at once and
+    a batched, early-abandoning DTW. As a measurement it reports 1 / (1 + distance), so higher is
+    more similar like the correlation measurements
+    """
+
+    def __init__(self, window=0.1, chunk_size=4096, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.window = window
+        self.chunk_size = chunk_size
+
+    def radius(self, window_size):
+        return max(1, int(round(self.window * window_size)))
+
+    def measure(self, s1, s2):
+        return self.measure_rows(s1, np.asarray(s2, dtype=np.float64)[np.newaxis, :])[0]
+
+    def measure_windows(self, pattern, series):
+        series = np.asarray(series, dtype=np.float64)
+        window_size = len(pattern)
+        if series.shape[0] < window_size:
+            return np.empty(0, dtype=np.float64)
+        # a view of the windows, measure_rows copies chunk_size of them at a time
+        return self.measure_rows(pattern, sliding_windows(series, window_size))
+
+    def measure_windows_many(self, patterns, series):
+        """ One column of measure_windows per pattern, DTW has no product to share between patterns """
+        return np.stack([self.measure_windows(pattern, series) for pattern in patterns], axis=1)
+
+    def measure_rows(self, pattern, windows, chunk_size=None):
+        """ Similarity of the pattern to every row of windows, without pruning, chunk_size rows at a time """
+        chunk_size = chunk_size or self.chunk_size
+        query = znormalize_rows(pattern)
+        distances = np.empty(windows.shape[0], dtype=np.float64)
+        for begin in range(0, windows.shape[0], chunk_size):
+            chunk = znormalize_rows(windows[begin:begin + chunk_size])
+            distances[begin:begin + chunk.shape[0]] = self.distances(query, chunk, np.full(chunk.shape[0], np.inf))
+        return self.similarity(distances)
+
+    def measure_normalized(self, query, windows):
+        """ measure_rows of an already z-normalized query and windows """
+        return self.similarity(self.distances(query, windows, np.full(windows.shape[0], np.inf)))
+
+    def correlation_normalized(self, query, windows):
+        """
+        The distances of measure_normalized on the scale of a correlation, 1 - distance / 2w. Without
+        warping the distance of z-normalized windows is 2w(1 - r), so this is Pearson's r with the
+        improvement the band allows, in [-1, 1]
+        """
+        return 1. - self.distances(query, windows, np.full(windows.shape[0], np.inf)) / (2. * windows.shape[1])
+
+    @staticmethod
+    def similarity(distances):
+        return 1. / (1. + distances)
+
+    def lower_bounds(self, query, upper, lower, windows):
+        """ max(LB_Kim, LB_Keogh) of the z-normalized windows against the query and its envelope """
+        first_last = (windows[:, 0] - query[0]) ** 2 + (windows[:, -1] - query[-1]) ** 2
+        above = np.maximum(windows - upper, 0.)
+        below = np.maximum(lower - windows, 0.)
+        keogh = np.einsum('ij,ij->i', above, above) + np.einsum('ij,ij->i', below, below)
+        if windows.shape[1] == 1:
+            first_last = first_last / 2.
+        return np.maximum(first_last, keogh)
+
+    def distances(self, query, windows, thresholds):
+        """
+        Banded DTW of query against every z-normalized row of windows. A row is abandoned, and
+        reported as inf, as soon as every cell of a DP row exceeds its threshold
+        """
+        n, width = windows.shape
+        radius = self.radius(width)
+        result = np.full(n, np.inf)
+        alive = np.arange(n)
+        windows = windows.copy()
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        previous = None
+        for i in range(width):
+            lo, hi = max(0, i - radius), min(width - 1, i + radius)
+            cost = (windows[:, lo:hi + 1] - query[i]) ** 2
+            current = np.full((windows.shape[0], width), np.inf)
+            if previous is None:
+                current[:, lo:hi + 1] = np.cumsum(cost, axis=1)
+            else:
+                # best of the diagonal and vertical predecessors, then the horizontal one in order
+                diagonal = np.concatenate((np.full((windows.shape[0], 1), np.inf), previous[:, :-1]), axis=1)
+                reach = np.minimum(previous[:, lo:hi + 1], diagonal[:, lo:hi + 1])
+                left = np.full(windows.shape[0], np.inf)
+                for j in range(hi - lo + 1):
+                    left = cost[:, j] + np.minimum(reach[:, j], left)
+                    current[:, lo + j] = left
+            keep = current[:, lo:hi + 1].min(axis=1) <= thresholds
+            if not keep.all():
+                alive, windows, thresholds, current = alive[keep], windows[keep], thresholds[keep], current[keep]
+                if alive.shape[0] == 0:
+                    return result
+            previous = current
+        result[alive] = previous[:, width - 1]
+        return result
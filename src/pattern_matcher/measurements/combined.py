@@ -0,0 +1,54 @@
+import logging
+import numpy as np
+from .banded_dtw import BandedDTW, znormalize_rows
+from .spearmanr import sliding_windows
+
+class CombinedMeasurement:
+    """
+    Several measurements of the same windows in one sweep. Each chunk of windows is extracted and
+    z-normalized once, then handed to every method. The similarity of a window is the mean of the
+    methods' scores in [-1, 1], NaN when any of them is undefined: correlations as they are and DTW
+    distances as the correlation they bound, see BandedDTW.correlation_normalized
+    """
+
+    def __init__(self, methods, chunk_size=4096, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.methods = list(methods)
+        self.chunk_size = chunk_size
+
+    def measure(self, s1, s2):
+        return self.measure_windows(s1, s2)[0]
+
+    def measure_windows(self, pattern, series):
+        """ Return one similarity per window start of series """
+        series = np.asarray(series, dtype=np.float64)
+        window_size = len(pattern)
+        if series.shape[0] < window_size:
+            return np.empty(0, dtype=np.float64)
+        return self.measure_rows(pattern, sliding_windows(series, window_size))
+
+    def measure_rows(self, pattern, windows):
+        """ Return one similarity per row of a 2D array of windows """
+        query = znormalize_rows(pattern)
+        similarities = np.empty(windows.shape[0], dtype=np.float64)
+        for begin in range(0, windows.shape[0], self.chunk_size):
+            chunk = znormalize_rows(windows[begin:begin + self.chunk_size])
+            scores = [self.scores(method, query, chunk) for method in self.methods]
+            similarities[begin:begin + chunk.shape[0]] = np.mean(scores, axis=0)
+        return similarities
+
+    @staticmethod
+    def scores(method, query, windows):
+        """ The method's scores of the z-normalized windows in [-1, 1] """
+        if isinstance(method, BandedDTW):
+            # 1 / (1 + distance) would weigh a DTW match against a correlation on another scale
+            return method.correlation_normalized(query, windows)
+        return method.measure_normalized(query, windows)
+
+    def measure_windows_many(self, patterns, series):
+        """ One column of measure_windows per pattern """
+        series = np.asarray(series, dtype=np.float64)
+        window_size = len(patterns[0])
+        if series.shape[0] < window_size:
+            return np.empty((0, len(patterns)), dtype=np.float64)
+        return np.stack([self.measure_windows(pattern, series) for pattern in patterns], axis=1)
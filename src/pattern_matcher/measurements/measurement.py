@@ -5,4 +5,13 @@ class Measurement:
         self.method = method
 
     def measure(self, s1, s2):
-        return self.method.measure(s1, s2)
\ No newline at end of file
+        return self.method.measure(s1, s2)
+
+    def measure_windows(self, pattern, series):
+        return self.method.measure_windows(pattern, series)
+
+    def measure_rows(self, pattern, windows):
+        return self.method.measure_rows(pattern, windows)
+
+    def measure_windows_many(self, patterns, series):
+        return self.method.measure_windows_many(patterns, series)
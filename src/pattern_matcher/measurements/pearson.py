@@ -1,5 +1,6 @@
 import logging
 import numpy as np
+from .spearmanr import sliding_windows
 
 class Pearson:
 
@@ -11,6 +12,90 @@ class Pearson:
             self.logger.info('Invalid input')
         return np.corrcoef(s1, s2, rowvar=False)
 
+class RollingPearson:
+    """
+    Pearson correlation of one pattern against every window of a series in a single pass.
+    Windows are read as strided views chunk_size at a time, each centered on its own mean and scored
+    against the z-normalized pattern with one matrix-vector product, so the cost is O(n * w) in numpy
+    rather than n python calls. Window sums are never taken from prefix sums of the whole series,
+    which cancel for cheap windows of a series that also holds expensive ones
+    """
+
+    # windows whose variance is below this fraction of their energy are treated as constant
+    _FLAT_TOLERANCE = 1e-10
+
+    def __init__(self, chunk_size=4096, logger = None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.chunk_size = chunk_size
+
+    def measure(self, s1, s2):
+        return self.measure_windows(s1, s2)[0]
+
+    def measure_windows(self, pattern, series):
+        """ Return one coefficient per window start of series, NaN for constant windows """
+        pattern = np.asarray(pattern, dtype=np.float64)
+        series = np.asarray(series, dtype=np.float64)
+        window_size = pattern.shape[0]
+        if series.shape[0] < window_size:
+            return np.empty(0, dtype=np.float64)
+
+        pattern_std = pattern.std()
+        if pattern_std == 0:
+            return np.full(series.shape[0] - window_size + 1, np.nan)
+        z_pattern = (pattern - pattern.mean()) / pattern_std
+        return self.measure_centered(z_pattern[:, np.newaxis], series)[:, 0]
+
+    def measure_centered(self, z_patterns, series):
+        """ (windows, patterns) coefficients of the columns of z_patterns, NaN for constant windows """
+        window_size = z_patterns.shape[0]
+        windows = sliding_windows(series, window_size)
+        coefficients = np.empty((windows.shape[0], z_patterns.shape[1]), dtype=np.float64)
+        for begin in range(0, windows.shape[0], self.chunk_size):
+            chunk = windows[begin:begin + self.chunk_size]
+            means = chunk.mean(axis=1)
+            centered = chunk - means[:, np.newaxis]
+            deviation = np.einsum('ij,ij->i', centered, centered)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scores = centered.dot(z_patterns) / np.sqrt(window_size * deviation)[:, np.newaxis]
+            # the energy of a window is its variance plus its squared mean
+            scores[deviation <= self._FLAT_TOLERANCE * (deviation + window_size * means * means)] = np.nan
+            coefficients[begin:begin + chunk.shape[0]] = scores
+        return np.clip(coefficients, -1., 1.)
+
+    def measure_rows(self, pattern, windows):
+        """ Return one coefficient per row of a 2D array of windows, NaN for constant rows """
+        pattern = np.asarray(pattern, dtype=np.float64)
+        windows = np.asarray(windows, dtype=np.float64)
+        centered_pattern = pattern - pattern.mean()
+        centered = windows - windows.mean(axis=1, keepdims=True)
+        norms = np.einsum('ij,ij->i', centered, centered)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coefficients = centered.dot(centered_pattern) / np.sqrt(norms * np.dot(centered_pattern, centered_pattern))
+        return np.clip(coefficients, -1., 1.)
+
+    def measure_normalized(self, query, windows):
+        """ measure_rows of an already z-normalized query and windows, flat rows are all zeros and give NaN """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coefficients = windows.dot(query) / query.shape[0]
+        coefficients[~windows.any(axis=1)] = np.nan
+        return np.clip(coefficients, -1., 1.)
+
+    def measure_windows_many(self, patterns, series):
+        """ Return a (windows, patterns) matrix of coefficients, every chunk of windows is centered once for all patterns """
+        patterns = np.asarray(patterns, dtype=np.float64)
+        series = np.asarray(series, dtype=np.float64)
+        window_size = patterns.shape[1]
+        if series.shape[0] < window_size:
+            return np.empty((0, patterns.shape[0]), dtype=np.float64)
+
+        pattern_stds = patterns.std(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z_patterns = (patterns - patterns.mean(axis=1, keepdims=True)) / pattern_stds[:, np.newaxis]
+        z_patterns[pattern_stds == 0] = 0.
+        coefficients = self.measure_centered(z_patterns.T, series)
+        coefficients[:, pattern_stds == 0] = np.nan
+        return coefficients
+
 if __name__ == "__main__":
     co = PearsonProductMoment()
     x = np.array([[1.1], [1.7], [2.1], [1.4], [0.2]])
@@ -13,3 +13,94 @@ class Spearmanr:
             self.logger.error('Invalid input')
             return
         return stats.spearmanr(s1, s2)
+
+def rank_rows(matrix):
+    """ 1-based ranks along each row with ties given their average rank, like scipy.stats.rankdata """
+    order = np.argsort(matrix, axis=1, kind='mergesort')
+    sorted_values = np.take_along_axis(matrix, order, axis=1)
+    width = matrix.shape[1]
+    positions = np.broadcast_to(np.arange(width), matrix.shape)
+
+    # a tie group spans from the first to the last position holding the same sorted value
+    group_start = np.ones(matrix.shape, dtype=bool)
+    group_start[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    group_end = np.ones(matrix.shape, dtype=bool)
+    group_end[:, :-1] = group_start[:, 1:]
+    first = np.maximum.accumulate(np.where(group_start, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(group_end, positions, width - 1)[:, ::-1], axis=1)[:, ::-1]
+
+    ranks = np.empty(matrix.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, (first + last) / 2. + 1, axis=1)
+    return ranks
+
+def sliding_windows(series, window_size):
+    """ Read-only 2D view of every window of series, one row per window start """
+    series = np.ascontiguousarray(series)
+    n_windows = series.shape[0] - window_size + 1
+    stride = series.strides[0]
+    return np.lib.stride_tricks.as_strided(series, shape=(n_windows, window_size), strides=(stride, stride), writeable=False)
+
+class BatchedSpearmanr:
+    """
+    Spearman correlation of one pattern against every window of a series.
+    The pattern is ranked once, windows are ranked in bulk chunk_size rows at a time
+    and each chunk is scored with a single matrix-vector product
+    """
+
+    def __init__(self, chunk_size=4096, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.chunk_size = chunk_size
+
+    def measure(self, s1, s2):
+        return self.measure_windows(s1, s2)[0]
+
+    def measure_windows(self, pattern, series):
+        """ Return one coefficient per window start of series, NaN for constant windows """
+        pattern = np.asarray(pattern, dtype=np.float64)
+        series = np.asarray(series, dtype=np.float64)
+        window_size = pattern.shape[0]
+        if series.shape[0] < window_size:
+            return np.empty(0, dtype=np.float64)
+        return self.measure_rows(pattern, sliding_windows(series, window_size))
+
+    def measure_rows(self, pattern, windows):
+        """ Return one coefficient per row of a 2D array of windows, NaN for constant rows """
+        pattern = np.asarray(pattern, dtype=np.float64)
+        # average ranks always sum to w(w+1)/2, so every rank vector has the same mean
+        mean_rank = (pattern.shape[0] + 1) / 2.
+        pattern_ranks = rank_rows(pattern[np.newaxis, :])[0] - mean_rank
+        pattern_norm = np.dot(pattern_ranks, pattern_ranks)
+
+        coefficients = np.empty(windows.shape[0], dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for begin in range(0, windows.shape[0], self.chunk_size):
+                ranks = rank_rows(windows[begin:begin + self.chunk_size]) - mean_rank
+                norms = np.einsum('ij,ij->i', ranks, ranks)
+                coefficients[begin:begin + ranks.shape[0]] = ranks.dot(pattern_ranks) / np.sqrt(pattern_norm * norms)
+        return coefficients
+
+    def measure_normalized(self, query, windows):
+        """ measure_rows of an already z-normalized query and windows, z-normalizing keeps the ranks """
+        return self.measure_rows(query, windows)
+
+    def measure_windows_many(self, patterns, series):
+        """ Return a (windows, patterns) matrix of coefficients, every chunk of windows is ranked once for all patterns """
+        patterns = np.asarray(patterns, dtype=np.float64)
+        series = np.asarray(series, dtype=np.float64)
+        window_size = patterns.shape[1]
+        if series.shape[0] < window_size:
+            return np.empty((0, patterns.shape[0]), dtype=np.float64)
+        windows = sliding_windows(series, window_size)
+
+        mean_rank = (window_size + 1) / 2.
+        pattern_ranks = rank_rows(patterns) - mean_rank
+        pattern_norms = np.einsum('ij,ij->i', pattern_ranks, pattern_ranks)
+
+        coefficients = np.empty((windows.shape[0], patterns.shape[0]), dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for begin in range(0, windows.shape[0], self.chunk_size):
+                ranks = rank_rows(windows[begin:begin + self.chunk_size]) - mean_rank
+                norms = np.einsum('ij,ij->i', ranks, ranks)
+                coefficients[begin:begin + ranks.shape[0]] = ranks.dot(pattern_ranks.T) / np.sqrt(np.outer(norms, pattern_norms))
+        return coefficients
+
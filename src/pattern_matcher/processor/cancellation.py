@@ -0,0 +1,26 @@
+import threading
+import time
+
+class CancellationToken:
+    """
+    Shared by a request and the processors working on it. It is cancelled once cancel() is called
+    or once its time budget, in seconds, has run out. Processors check it between tickers or shards
+    and stop handing out work, what finished so far is still returned
+    """
+
+    def __init__(self, budget=None):
+        self.deadline = time.time() + budget if budget is not None else None
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self, grace=0.):
+        """ Whether cancel() was called or the deadline, pushed back by grace seconds, has passed """
+        return self._cancelled.is_set() or (self.deadline is not None and time.time() >= self.deadline + grace)
+
+    def remaining(self, cap, grace=0.):
+        """ Seconds to wait for work before checking the token again, at most cap """
+        if self.deadline is None:
+            return cap
+        return max(0., min(cap, self.deadline + grace - time.time()))
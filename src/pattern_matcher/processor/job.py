@@ -4,6 +4,14 @@ class Job:
         self.name = name
         self.exec = exec
         self.args = args
+        # filled in by the JobScheduler
+        self.id = None
+        self.status = 'new'
+        self.result = None
+        self.error = None
+        self.submitted = None
+        self.started = None
+        self.finished = None
 
     def get_job_info(self):
-        return 'Job info: [name: {0}, exec: {1}, args: {2}]'.format(self.name, self.exec, self.args)
\ No newline at end of file
+        return 'Job info: [name: {0}, exec: {1}, args: {2}]'.format(self.name, self.exec, self.args)
@@ -1,6 +1,10 @@
 import logging
 import concurrent.futures
 import os, time
+from ..loader.packed import PublishedDataset
+from ..loader.frame_cache import LazyFrames
+from .worker_pool import ShardedWorkerPool
+from .scheduler import FairProcessPool
 
 class Processor():
 
@@ -10,6 +14,17 @@ class Processor():
         """ Actually do the execution. Currently using Pool class for parallel execution """
         pass
 
+    def load(self, data, changed=None):
+        """ Called by the runner whenever new data has been loaded, changed lists the tickers re-read by a refresh """
+        pass
+
+    def process_iter(self, data, job, concurrency=os.cpu_count(), token=None, priority=None):
+        """
+        Yield (done, total, results) as parts of the work finish, by default everything at once.
+        Stops early once the CancellationToken is cancelled, tickers with a higher priority go first
+        """
+        yield 1, 1, self.process(data, job, concurrency)
+
 class MultiThreadingMeasurementProcessor(Processor):
 
     def __init__(self, logger=None):
@@ -37,29 +52,116 @@ class MultiThreadingMeasurementProcessor(Processor):
             return rs
 
 class MultiProcessingMeasurementProcessor(Processor):
+    """ One task per ticker on a process pool shared by all requests, which take turns handing it tasks """
 
-    def __init__(self, logger=None):
+    # seconds between checks of a cancellation token while tickers are running
+    _POLL_INTERVAL = 0.1
+
+    def __init__(self, concurrency=os.cpu_count(), logger=None):
         Processor.__init__(self)
         self.logger = logger or logging.getLogger(__name__)
+        self.pool = FairProcessPool(concurrency)
 
     def process(self, data, job, concurrency=os.cpu_count()):
+        rs = []
+        for _, _, results in self.process_iter(data, job, concurrency):
+            rs.extend(results)
+        return rs
+
+    def process_iter(self, data, job, concurrency=os.cpu_count(), token=None, priority=None):
         begin_time = time.time()
 
         self.logger.debug('Processing in multiprocessing job with info: %s', job.get_job_info())
         pattern_close_values = job.args[0]
         days_forward = job.args[1]
         steps = job.args[2]
+
+        tickers = list(data.tickers) if isinstance(data, PublishedDataset) else list(data.keys())
+        if priority is not None:
+            # the pool starts a request's tasks in order
+            tickers.sort(key=lambda ticker: -priority.get(ticker, 0.))
         
-        rs = []
-        self.logger.info('Running job with %s processes', concurrency)
-        with concurrent.futures.ProcessPoolExecutor(max_workers=concurrency) as executor:
-            future_results = { executor.submit(job.exec, begin_time, ticker, dataframe, pattern_close_values, days_forward, steps): dataframe for ticker, dataframe in data.items()}
-            for future in concurrent.futures.as_completed(future_results):
-                try:
-                    result = future.result()
-                except Exception as exc:
-                    self.logger.error('Failed to process. Exception follows. %s', exc)
-                else:
-                    rs.append(result)
-            return rs
-    
\ No newline at end of file
+        self.logger.info('Running job on %s shared processes', self.pool.workers)
+        # a published dataset is sent as its path, workers map the ticker's rows themselves
+        if isinstance(data, LazyFrames):
+            # frames are read by the requesting thread just ahead of the pool, those not cached are not kept
+            tasks = [lambda ticker=ticker: (begin_time, ticker, data.stream(ticker), pattern_close_values, days_forward, steps) for ticker in tickers]
+        else:
+            tasks = [(begin_time, ticker, data if isinstance(data, PublishedDataset) else data[ticker], pattern_close_values, days_forward, steps) for ticker in tickers]
+        done = 0
+        for _, future in self.pool.imap_unordered(job.exec, tasks, token, self._POLL_INTERVAL):
+            done += 1
+            try:
+                result = future.result()
+            except Exception as exc:
+                self.logger.error('Failed to process. Exception follows. %s', exc)
+                yield done, len(tasks), []
+            else:
+                yield done, len(tasks), [result]
+        if done < len(tasks):
+            self.logger.info('Job cancelled after %s of %s tickers', done, len(tasks))
+
+class PackedMeasurementProcessor(Processor):
+    """ Runs the job once over a PackedDataset instead of fanning out one task per ticker """
+
+    # parts of the universe matched one after the other under a cancellation token
+    _PARTS = 16
+
+    def __init__(self, logger=None):
+        Processor.__init__(self)
+        self.logger = logger or logging.getLogger(__name__)
+
+    def process(self, data, job, concurrency=os.cpu_count()):
+        begin_time = time.time()
+
+        self.logger.debug('Processing packed job with info: %s', job.get_job_info())
+        self.logger.info('Running job over %s tickers, %s bars', len(data), data.total_bars())
+        return job.exec(begin_time, data, *job.args)
+
+    def process_iter(self, data, job, concurrency=os.cpu_count(), token=None, priority=None):
+        if token is None:
+            yield 1, 1, self.process(data, job, concurrency)
+            return
+        begin_time = time.time()
+
+        # under a token the universe is matched in parts, views of the same arrays, checking the token in between
+        edges = sorted(set(len(data) * k // self._PARTS for k in range(self._PARTS + 1)))
+        parts = list(zip(edges[:-1], edges[1:]))
+        if priority is not None:
+            parts.sort(key=lambda part: -max(priority.get(ticker, 0.) for ticker in data.tickers[part[0]:part[1]]))
+        self.logger.debug('Processing packed job in %s parts with info: %s', len(parts), job.get_job_info())
+        for done, (begin, end) in enumerate(parts, 1):
+            if token.cancelled():
+                self.logger.info('Job cancelled after %s of %s parts', done - 1, len(parts))
+                return
+            yield done, len(parts), job.exec(begin_time, data.slice(begin, end), *job.args)
+
+
+class PooledMeasurementProcessor(Processor):
+    """ Dispatches jobs to a persistent ShardedWorkerPool that keeps the data resident between requests """
+
+    def __init__(self, concurrency=os.cpu_count(), logger=None):
+        Processor.__init__(self)
+        self.logger = logger or logging.getLogger(__name__)
+        self.pool = ShardedWorkerPool(concurrency)
+
+    def load(self, data, changed=None):
+        self.pool.load(data, changed)
+
+    def process(self, data, job, concurrency=os.cpu_count()):
+        begin_time = time.time()
+
+        self.logger.debug('Processing pooled job with info: %s', job.get_job_info())
+        self.logger.info('Running job on %s resident workers', self.pool.size)
+        return self.pool.map(job.exec, begin_time, job.args, data.version)
+
+    def process_iter(self, data, job, concurrency=os.cpu_count(), token=None, priority=None):
+        begin_time = time.time()
+
+        # shards run side by side, a cancelled request stops waiting and late replies are dropped
+        self.logger.debug('Processing pooled job with info: %s', job.get_job_info())
+        done = 0
+        for _, results, whole in self.pool.map_iter(job.exec, begin_time, job.args, data.version, token):
+            # a shard cut short by the deadline does not count as done
+            done += 1 if whole else 0
+            yield done, self.pool.size, results
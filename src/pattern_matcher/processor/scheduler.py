@@ -0,0 +1,292 @@
+import collections
+import concurrent.futures
+import itertools
+import logging
+import math
+import queue
+import threading
+import time
+
+class SchedulerBusy(Exception):
+    """ Raised when a job arrives while the scheduler's queue is full """
+
+    def __init__(self, queued, retry_after):
+        Exception.__init__(self, 'Match queue is full: {0} jobs waiting'.format(queued))
+        self.queued = queued
+        self.retry_after = retry_after
+
+class DeadlineExpired(SchedulerBusy):
+    """ Raised when a job's CancellationToken runs out while it waits for its turn, it is taken out of the queue """
+
+    def __init__(self, queued, retry_after):
+        Exception.__init__(self, 'Deadline passed while waiting behind {0} jobs'.format(queued))
+        self.queued = queued
+        self.retry_after = retry_after
+
+class JobScheduler:
+    """
+    Process-wide admission control for match jobs. At most running jobs execute at once, up to
+    queue_size more wait their turn in arrival order and any beyond that are refused with
+    SchedulerBusy. Jobs run either in the caller's thread (run) or in the background (submit),
+    the last keep of them can be polled by id. A job waiting with a CancellationToken leaves the
+    queue with DeadlineExpired once the token runs out, it is never handed a turn it cannot use
+    """
+
+    # seconds between checks of a waiting job's token, cancel() does not wake the queue
+    _POLL_INTERVAL = 0.1
+
+    def __init__(self, running, queue_size, keep=256, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.running = running
+        self.queue_size = queue_size
+        self.keep = keep
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = collections.deque()
+        self._jobs = collections.OrderedDict()
+        self._ids = itertools.count(1)
+        # moving average of job run time, the basis of Retry-After
+        self._duration = None
+        self._admitted = 0
+        self._rejected = 0
+        self._expired = 0
+
+    def run(self, job, reject=True, token=None):
+        """ Wait for a turn, then run job in this thread and return its result. reject=False queues beyond queue_size """
+        self._enqueue(job, reject)
+        return self._execute(job, token)
+
+    def submit(self, job, token=None):
+        """ Queue job to run in the background and return it, poll it with get(job.id) """
+        self._enqueue(job, True)
+        threading.Thread(target=self._background, args=(job, token), daemon=True).start()
+        return job
+
+    def admit(self, job, token=None, reject=True):
+        """
+        Wait for a turn without running anything, the caller runs the work and calls release(job).
+        The same job can be admitted again after its release, e.g. for every part of a stream
+        """
+        self._enqueue(job, reject)
+        self._wait_turn(job, token)
+
+    def release(self, job):
+        with self._condition:
+            self._active -= 1
+            job.finished = time.time()
+            duration = job.finished - job.started
+            self._duration = duration if self._duration is None else 0.8 * self._duration + 0.2 * duration
+            self._condition.notify_all()
+
+    def record(self, job, result):
+        """ Register a job answered without running, e.g. from a cache, so it can be polled like the others """
+        with self._condition:
+            job.id = next(self._ids)
+            job.submitted = job.started = job.finished = time.time()
+            job.status, job.result = 'done', result
+            self._register(job)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def position(self, job):
+        """ 1-based place of a queued job in line, None once it started """
+        with self._condition:
+            for place, waiting in enumerate(self._waiting, 1):
+                if waiting is job:
+                    return place
+        return None
+
+    def stats(self):
+        with self._condition:
+            return {
+                'running': self._active,
+                'queued': len(self._waiting),
+                'max_running': self.running,
+                'queue_size': self.queue_size,
+                'admitted': self._admitted,
+                'rejected': self._rejected,
+                'expired': self._expired,
+                'average_seconds': self._duration
+            }
+
+    def _enqueue(self, job, reject):
+        with self._condition:
+            busy = self._active >= self.running or len(self._waiting) > 0
+            if reject and busy and len(self._waiting) >= self.queue_size:
+                self._rejected += 1
+                raise SchedulerBusy(len(self._waiting), self._retry_after())
+            job.status = 'queued'
+            self._waiting.append(job)
+            if job.id is None:
+                job.id = next(self._ids)
+                job.submitted = time.time()
+                self._register(job)
+
+    def _wait_turn(self, job, token=None):
+        with self._condition:
+            while True:
+                if token is not None and token.cancelled():
+                    self._waiting.remove(job)
+                    job.status = 'failed'
+                    job.error = 'Deadline passed while queued'
+                    job.finished = time.time()
+                    self._expired += 1
+                    # the job behind it may be first in line now
+                    self._condition.notify_all()
+                    raise DeadlineExpired(len(self._waiting), self._retry_after())
+                if self._waiting[0] is job and self._active < self.running:
+                    break
+                self._condition.wait(token.remaining(self._POLL_INTERVAL) if token is not None else None)
+            self._waiting.popleft()
+            self._active += 1
+            self._admitted += 1
+            job.started = time.time()
+            job.status = 'running'
+            # the next job in line may fit as well
+            self._condition.notify_all()
+
+    def _execute(self, job, token=None):
+        self._wait_turn(job, token)
+        try:
+            job.result = job.exec(*job.args)
+            job.status = 'done'
+            return job.result
+        except Exception as e:
+            job.status = 'failed'
+            job.error = '{0}: {1}'.format(type(e).__name__, e)
+            self.logger.error('Job %s failed. Exception follows. %s', job.name, job.error)
+            raise
+        finally:
+            self.release(job)
+
+    def _background(self, job, token):
+        try:
+            self._execute(job, token)
+        except Exception:
+            # the job's status and error tell the poller
+            pass
+
+    def _register(self, job):
+        self._jobs[job.id] = job
+        # forget the oldest finished jobs, queued and running ones stay pollable
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.keep:
+                break
+            if self._jobs[job_id].status in ('done', 'failed'):
+                del self._jobs[job_id]
+
+    def _retry_after(self):
+        return int(math.ceil((len(self._waiting) + 1) * (self._duration or 1.) / self.running))
+
+class FairProcessPool:
+    """
+    One ProcessPoolExecutor shared by every request of a processor instead of one per request.
+    Each request's tasks wait in their own queue and are handed to the executor round robin,
+    never more than workers at a time, so concurrent scans share the processes evenly
+    """
+
+    class _Stream:
+
+        def __init__(self, func, tasks):
+            self.func = func
+            # tasks whose arguments are not built yet, only the requesting thread takes from them
+            self.pending = collections.deque(tasks)
+            # (task, arguments) waiting for a worker
+            self.ready = collections.deque()
+            self.completed = queue.Queue()
+
+    def __init__(self, workers, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.RLock()
+        # streams with tasks left, in round robin order
+        self._streams = collections.deque()
+        self._in_flight = 0
+
+    def imap_unordered(self, func, tasks, token=None, poll_interval=0.1):
+        """
+        Yield (task, future) as the tasks complete. A task is an argument tuple of func, or a function
+        returning one, called in this thread up to workers tasks ahead of the pool. Stops early once
+        token is cancelled
+        """
+        stream = self._Stream(func, tasks)
+        total = len(stream.pending)
+        try:
+            for _ in range(total):
+                self._prepare(stream)
+                while True:
+                    if token is not None and token.cancelled():
+                        return
+                    try:
+                        yield stream.completed.get(timeout=token.remaining(poll_interval) if token is not None else None)
+                        break
+                    except queue.Empty:
+                        continue
+        finally:
+            # tasks not handed out yet are dropped, running ones finish and are ignored
+            with self._lock:
+                stream.pending.clear()
+                stream.ready.clear()
+                if stream in self._streams:
+                    self._streams.remove(stream)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def _prepare(self, stream):
+        """
+        Build the arguments of the stream's next tasks and queue them for the pool. Runs in the requesting
+        thread outside the lock, so reading a frame from disk holds up neither other requests nor the
+        executor's thread calling _done. Lazy tasks are built only while fewer than workers wait
+        """
+        with self._lock:
+            room = self.workers - len(stream.ready)
+        ready = []
+        while stream.pending and (not callable(stream.pending[0]) or len(ready) < room):
+            task = stream.pending.popleft()
+            if not callable(task):
+                ready.append((task, task))
+                continue
+            try:
+                ready.append((task, task()))
+            except Exception as e:
+                future = concurrent.futures.Future()
+                future.set_exception(e)
+                stream.completed.put((task, future))
+        with self._lock:
+            stream.ready.extend(ready)
+            if stream.ready and stream not in self._streams:
+                self._streams.append(stream)
+            self._dispatch()
+
+    def _dispatch(self):
+        while self._in_flight < self.workers and self._streams:
+            stream = self._streams.popleft()
+            task, args = stream.ready.popleft()
+            if stream.ready:
+                self._streams.append(stream)
+            future = self._submit(stream.func, args)
+            self._in_flight += 1
+            future.add_done_callback(lambda future, stream=stream, task=task: self._done(stream, task, future))
+
+    def _submit(self, func, task):
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            return self._executor.submit(func, *task)
+        except concurrent.futures.process.BrokenProcessPool:
+            self.logger.error('Worker processes died, starting new ones')
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor.submit(func, *task)
+
+    def _done(self, stream, task, future):
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch()
+        stream.completed.put((task, future))
@@ -0,0 +1,232 @@
+import logging
+import multiprocessing
+import threading
+import queue
+import itertools
+import time
+import zlib
+import numpy as np
+from ..loader.packed import PackedDataset
+
+logger = logging.getLogger(__name__)
+
+# parts a worker splits its shard into when a request has a deadline
+_PARTS = 8
+
+def shard_of(ticker, size):
+    """ Deterministic worker index of a ticker, stable across reloads and restarts """
+    return zlib.crc32(ticker.encode('utf-8')) % size
+
+def take_shard(dataset, tickers):
+    """ Private copy of the given tickers of a PackedDataset """
+    lengths = np.array([dataset.offsets[dataset.position(t) + 1] - dataset.offsets[dataset.position(t)] for t in tickers], dtype=np.int64)
+    offsets = np.zeros(len(tickers) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    dates = np.empty(offsets[-1], dtype=dataset.dates.dtype)
+    closes = np.empty(offsets[-1], dtype=dataset.closes.dtype)
+    for i, ticker in enumerate(tickers):
+        dates[offsets[i]:offsets[i + 1]], closes[offsets[i]:offsets[i + 1]] = dataset.series(ticker)
+    return PackedDataset(tickers, offsets, dates, closes)
+
+def _match_until(func, begin_time, shard, args, deadline):
+    """ func over the shard, in _PARTS parts when there is a deadline. Returns (results, whether all parts ran) """
+    if deadline is None:
+        return func(begin_time, shard, *args), True
+    edges = sorted(set(len(shard) * k // _PARTS for k in range(_PARTS + 1)))
+    rs = []
+    for begin, end in zip(edges[:-1], edges[1:]):
+        if time.time() >= deadline:
+            return rs, False
+        rs.extend(func(begin_time, shard.slice(begin, end), *args))
+    return rs, True
+
+def _worker_main(index, tasks, results):
+    # the current and the previous version, so requests started before a reload finish on their data
+    shards = dict()
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        kind, request_id = task[0], task[1]
+        try:
+            if kind == 'load':
+                published, tickers, version = task[2], task[3], task[4]
+                shards[version] = take_shard(published.attach(), tickers)
+                published.detach()
+                for old in sorted(shards)[:-2]:
+                    del shards[old]
+                results.put((request_id, index, True, shards[version].total_bars()))
+            elif kind == 'keep':
+                # none of the shard's tickers changed, the new version shares the previous one's arrays
+                previous, version = task[2], task[3]
+                if previous not in shards:
+                    raise Exception('Data version {0} is no longer loaded'.format(previous))
+                shards[version] = shards[previous]
+                for old in sorted(shards)[:-2]:
+                    del shards[old]
+                results.put((request_id, index, True, shards[version].total_bars()))
+            else:
+                func, begin_time, args, version, deadline = task[2], task[3], task[4], task[5], task[6]
+                if version not in shards:
+                    raise Exception('Data version {0} is no longer loaded'.format(version))
+                results.put((request_id, index, True, _match_until(func, begin_time, shards[version], args, deadline)))
+        except Exception as e:
+            results.put((request_id, index, False, '{0}: {1}'.format(type(e).__name__, e)))
+
+class _Request:
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.replies = dict()
+        # indexes of the workers whose reply came in, in arrival order
+        self.arrived = queue.Queue()
+
+class ShardedWorkerPool:
+    """
+    Long-lived worker processes, each keeping its shard of the tickers resident.
+    Tickers are assigned with shard_of, a request only ships the function and its arguments
+    to every worker and gathers one reply per shard. load() replaces the shards in place
+    """
+
+    _POLL_INTERVAL = 1.0
+    # seconds past a deadline to wait for the replies workers send when they hit it
+    _GRACE = 0.05
+
+    def __init__(self, size, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.size = size
+        self._results = multiprocessing.Queue()
+        self._tasks = [None] * size
+        self._workers = [None] * size
+        self._shards = [[] for _ in range(size)]
+        # the published data each worker's shard was last loaded from
+        self._published = [None] * size
+        self._version = None
+        self._ids = itertools.count()
+        self._pending = dict()
+        self._lock = threading.Lock()
+        for index in range(size):
+            self._start_worker(index)
+        self._reader = threading.Thread(target=self._read_results, daemon=True)
+        self._reader.start()
+
+    def _start_worker(self, index):
+        self._tasks[index] = multiprocessing.Queue()
+        self._workers[index] = multiprocessing.Process(target=_worker_main, args=(index, self._tasks[index], self._results), daemon=True)
+        self._workers[index].start()
+
+    def _read_results(self):
+        while True:
+            request_id, index, ok, payload = self._results.get()
+            with self._lock:
+                request = self._pending.get(request_id)
+                if request is None:
+                    continue
+                request.replies[index] = (ok, payload)
+                request.arrived.put(index)
+
+    def _submit(self, make_task):
+        return dict(self._replies(make_task))
+
+    def _replies(self, make_task, token=None):
+        """ Send one task to every worker and yield (worker index, (ok, payload)) as replies arrive, until token is cancelled """
+        request_id = next(self._ids)
+        request = _Request(self.size)
+        with self._lock:
+            self._pending[request_id] = request
+        for index in range(self.size):
+            self._tasks[index].put(make_task(request_id, index))
+        try:
+            received = 0
+            while received < request.expected:
+                if token is not None and token.cancelled(self._GRACE):
+                    self.logger.info('Request cancelled with %s of %s shards replied', received, request.expected)
+                    return
+                try:
+                    index = request.arrived.get(timeout=token.remaining(self._POLL_INTERVAL, self._GRACE) if token is not None else self._POLL_INTERVAL)
+                except queue.Empty:
+                    dead = [index for index, worker in enumerate(self._workers) if not worker.is_alive() and index not in request.replies]
+                    if dead:
+                        self._restart(dead)
+                        raise Exception('Lost pattern matcher workers: {0}'.format(dead))
+                    continue
+                received += 1
+                yield index, request.replies[index]
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+
+    def _restart(self, indexes):
+        for index in indexes:
+            self.logger.error('Restarting pattern matcher worker %s', index)
+            self._start_worker(index)
+            if self._published[index] is not None:
+                self._tasks[index].put(('load', next(self._ids), self._published[index], self._shards[index], self._version))
+
+    def load(self, dataset, changed=None):
+        """
+        Re-shard a PackedDataset onto the running workers under dataset.version. With changed, the tickers
+        re-read since the loaded version, only the shards holding one of them or losing a ticker are
+        published and copied again, the others keep their arrays under the new version
+        """
+        shards = [[] for _ in range(self.size)]
+        for ticker in dataset.tickers:
+            shards[shard_of(ticker, self.size)].append(ticker)
+        if changed is None or self._version is None:
+            touched = set(range(self.size))
+        else:
+            touched = set(shard_of(ticker, self.size) for ticker in changed)
+            touched.update(index for index in range(self.size) if shards[index] != self._shards[index])
+        # only the touched shards' tickers are written out
+        published = take_shard(dataset, [ticker for index in sorted(touched) for ticker in shards[index]]).publish() if touched else None
+        previous = self._version
+
+        def task(request_id, index):
+            if index in touched:
+                return 'load', request_id, published, shards[index], dataset.version
+            return 'keep', request_id, previous, dataset.version
+        replies = self._submit(task)
+        failed = {index: payload for index, (ok, payload) in replies.items() if not ok}
+        if failed:
+            raise Exception('Failed to load shards: {0}'.format(failed))
+        # kept so a restarted worker can reload its shard, the files of a handle no shard uses go away with it
+        self._published = [published if index in touched else self._published[index] for index in range(self.size)]
+        self._shards, self._version = shards, dataset.version
+        self.logger.info('Loaded %s tickers into %s of %s workers, bars per worker: %s', len(dataset), len(touched), self.size, [replies[i][1] for i in range(self.size)])
+
+    def map(self, func, begin_time, args, version=None):
+        """
+        Run func(begin_time, shard, *args) on the given version of every shard and concatenate the returned
+        lists. Raises when a shard failed, like when a worker died, rather than answer without its tickers
+        """
+        shards = dict()
+        for index, results, whole in self.map_iter(func, begin_time, args, version):
+            # without a deadline only a failure cuts a shard short
+            if not whole:
+                raise Exception('Failed to process shard {0}'.format(index))
+            shards[index] = results
+        rs = []
+        for index in sorted(shards):
+            rs.extend(shards[index])
+        return rs
+
+    def map_iter(self, func, begin_time, args, version=None, token=None):
+        """
+        Same as map, but yields (worker index, returned list, whether the whole shard ran) as each shard
+        finishes, failed shards give empty lists. The token's deadline goes to the workers, which match
+        their shard in parts and reply with the parts done by then. An explicit cancel only stops the wait,
+        the workers finish the shard they are on
+        """
+        version = self._version if version is None else version
+        deadline = token.deadline if token is not None else None
+        for index, (ok, payload) in self._replies(lambda request_id, index: ('match', request_id, func, begin_time, args, version, deadline), token):
+            if not ok:
+                self.logger.error('Failed to process shard %s. Exception follows. %s', index, payload)
+                payload = ([], False)
+            yield index, payload[0], payload[1]
+
+    def close(self):
+        for tasks in self._tasks:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join()
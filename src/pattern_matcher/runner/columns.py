@@ -0,0 +1,90 @@
+import json, struct
+import numpy as np
+
+# media types of the compact /match response
+COLUMNS_JSON = 'application/vnd.pattern-matcher.columns+json'
+COLUMNS_BINARY = 'application/vnd.pattern-matcher.columns'
+
+# a binary response starts with the length of its json header
+_HEADER = struct.Struct('<I')
+
+def to_columns(ticker, pattern_close_values, pattern_date_values, predict, complete=True):
+    """
+    The /match response as parallel arrays, one row per match in rank order. Matches over the same
+    dates share one time axis: history_axis and future_axis index into axes
+    """
+    axes, axis_ids = [], dict()
+    def axis(dates):
+        dates = np.asarray(dates, dtype=np.int64)
+        key = dates.tobytes()
+        if key not in axis_ids:
+            axis_ids[key] = len(axes)
+            axes.append(dates)
+        return axis_ids[key]
+
+    return {
+        'origin': {
+            'ticker': ticker,
+            'values': np.asarray(pattern_close_values, dtype=np.float64),
+            'time': np.asarray(pattern_date_values, dtype=np.int64)
+        },
+        'tickers': [item[0] for item in predict],
+        'similarity': np.array([item[1] for item in predict], dtype=np.float64),
+        'history': rows([item[2][0] for item in predict], np.float64),
+        'future': rows([item[2][2] for item in predict], np.float64),
+        'history_axis': np.array([axis(item[2][1]) for item in predict], dtype=np.int32),
+        'future_axis': np.array([axis(item[2][3]) for item in predict], dtype=np.int32),
+        'axes': axes,
+        'complete': complete
+    }
+
+def rows(values, dtype):
+    if not values:
+        return np.empty((0, 0), dtype=dtype)
+    return np.array(values, dtype=dtype)
+
+def from_response(response):
+    """ Columns of a response in the nested /match format, e.g. one read from the precomputed table """
+    matches = [response['matches'][rank] for rank in sorted(response['matches'])]
+    predict = [(match['ticker'], match['similarity'], (match['history'], match['hitory_time'], match['future'], match['future_time'])) for match in matches]
+    return to_columns(response['origin']['ticker'], response['origin']['values'], response['origin']['time'], predict, response.get('complete', True))
+
+def encode_json(columns):
+    """ Columns as compact json, every array converted in one call """
+    origin = columns['origin']
+    return json.dumps({
+        'origin': {'ticker': origin['ticker'], 'values': origin['values'].tolist(), 'time': origin['time'].tolist()},
+        'tickers': columns['tickers'],
+        'similarity': columns['similarity'].tolist(),
+        'history': columns['history'].tolist(),
+        'future': columns['future'].tolist(),
+        'history_axis': columns['history_axis'].tolist(),
+        'future_axis': columns['future_axis'].tolist(),
+        'axes': [axis.tolist() for axis in columns['axes']],
+        'complete': columns['complete']
+    }, separators=(',', ':'))
+
+def encode_binary(columns):
+    """
+    Columns as a little-endian binary: a <I length, a json header naming the ticker, tickers and
+    complete, and [dtype, shape, offset] of every array, then the raw array buffers in that order
+    """
+    arrays = [('values', columns['origin']['values']), ('time', columns['origin']['time']),
+              ('similarity', columns['similarity']), ('history', columns['history']), ('future', columns['future']),
+              ('history_axis', columns['history_axis']), ('future_axis', columns['future_axis'])]
+    arrays += [('axis{0}'.format(k), axis) for k, axis in enumerate(columns['axes'])]
+
+    layout, buffers, offset = dict(), [], 0
+    for name, array in arrays:
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+        layout[name] = [array.dtype.str, list(array.shape), offset]
+        buffers.append(array.tobytes())
+        offset += array.nbytes
+    header = json.dumps({
+        'ticker': columns['origin']['ticker'],
+        'tickers': columns['tickers'],
+        'axes': len(columns['axes']),
+        'complete': columns['complete'],
+        'arrays': layout
+    }, separators=(',', ':')).encode('utf-8')
+    return b''.join([_HEADER.pack(len(header)), header] + buffers)
@@ -0,0 +1,132 @@
+import hashlib, json, logging, mmap, os, struct, time, uuid, zlib
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# a table file ends with the offset of its json index
+_TRAILER = struct.Struct('<Q')
+
+# the measurement settings that change answers, processing settings do not
+_MATCHING_KEYS = ('type', 'engine', 'per_ticker', 'exclusion', 'dtw')
+
+def data_fingerprint(snapshot, measurement_conf):
+    """ Digest of the matching conf and every bar of the snapshot, a table only answers for data with its fingerprint """
+    matching = {key: measurement_conf[key] for key in _MATCHING_KEYS if key in measurement_conf}
+    digest = hashlib.sha1(json.dumps(matching, sort_keys=True).encode('utf-8'))
+    checksum = 0
+    for ticker in sorted(snapshot.tickers):
+        if snapshot.packed is not None:
+            dates, closes = snapshot.packed.series(ticker)
+        else:
+            frame = snapshot.frames[ticker]
+            dates, closes = frame.iloc[:, 0].values, frame.iloc[:, 1].values
+        digest.update(ticker.encode('utf-8'))
+        checksum = zlib.crc32(np.ascontiguousarray(dates, dtype=np.int64).tobytes(), checksum)
+        checksum = zlib.crc32(np.ascontiguousarray(closes, dtype=np.float64).tobytes(), checksum)
+    digest.update(str(checksum).encode('utf-8'))
+    return digest.hexdigest()
+
+def entry_key(ticker, days_back, days_forward):
+    return '{0}|{1}|{2}'.format(ticker, days_back, days_forward)
+
+def truncate_response(response, top):
+    """ The response of a /match with a smaller top: its first top matches, integer keys as built by convert_to_json """
+    return {
+        'origin': response['origin'],
+        'history_time_set': {int(day): times[:top + 1] for day, times in response['history_time_set'].items()},
+        'future_time_set': {int(day): times[:top] for day, times in response['future_time_set'].items()},
+        'matches': {int(rank): match for rank, match in response['matches'].items() if int(rank) <= top},
+        'complete': response.get('complete', True)
+    }
+
+class MatchTable:
+    """ One precomputed table file, mapped read-only. Entries are zlib compressed /match responses """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, = _TRAILER.unpack_from(self._data, len(self._data) - _TRAILER.size)
+        index = json.loads(self._data[index_offset:len(self._data) - _TRAILER.size].decode('utf-8'))
+        self.fingerprint = index['fingerprint']
+        self.top = index['top']
+        self.meta = index['meta']
+        self._entries = index['entries']
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, ticker, days_back, days_forward, top):
+        """ The precomputed response, or None when the key was not precomputed or top exceeds the table's """
+        entry = self._entries.get(entry_key(ticker, days_back, days_forward))
+        if entry is None or top > self.top:
+            return None
+        offset, length = entry
+        return truncate_response(json.loads(zlib.decompress(self._data[offset:offset + length]).decode('utf-8')), top)
+
+    def close(self):
+        self._data.close()
+
+class MatchTableStore:
+    """
+    Directory of precomputed match tables, each a single file of compressed responses followed by
+    a json index of their offsets. CURRENT names the latest table, like the ColumnStore
+    """
+
+    _KEEP = 2
+
+    def __init__(self, directory, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def current(self):
+        try:
+            with open(os.path.join(self.directory, 'CURRENT'), 'r') as f:
+                path = os.path.join(self.directory, f.read().strip())
+        except IOError:
+            return None
+        return path if os.path.isfile(path) else None
+
+    def load(self):
+        path = self.current()
+        if path is None:
+            return None
+        try:
+            return MatchTable(path)
+        except (IOError, ValueError, KeyError, struct.error) as e:
+            self.logger.error('Ignoring unreadable match table: %s. Exception follows. %s', path, e)
+            return None
+
+    def write(self, fingerprint, top, entries, meta):
+        """ Write entries, an iterable of ((ticker, days_back, days_forward), response), as the current table and return it """
+        name = '{0:017d}-{1}.table'.format(int(time.time() * 10 ** 6), uuid.uuid4().hex[:8])
+        path = os.path.join(self.directory, name)
+        index = dict()
+        with open(path, 'wb') as f:
+            for key, response in entries:
+                blob = zlib.compress(json.dumps(response, separators=(',', ':')).encode('utf-8'))
+                index[entry_key(*key)] = (f.tell(), len(blob))
+                f.write(blob)
+            index_offset = f.tell()
+            f.write(json.dumps({'fingerprint': fingerprint, 'top': top, 'meta': meta, 'entries': index}).encode('utf-8'))
+            f.write(_TRAILER.pack(index_offset))
+
+        pointer = os.path.join(self.directory, 'CURRENT.' + uuid.uuid4().hex[:8])
+        with open(pointer, 'w') as f:
+            f.write(name)
+        os.replace(pointer, os.path.join(self.directory, 'CURRENT'))
+        self.logger.info('Wrote match table %s: %s entries, %s bytes', name, len(index), os.path.getsize(path))
+        self.prune()
+        return MatchTable(path)
+
+    def prune(self):
+        current = os.path.basename(self.current() or '')
+        tables = sorted(entry for entry in os.listdir(self.directory) if entry.endswith('.table'))
+        for entry in tables[:-self._KEEP]:
+            if entry == current:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, entry))
+            except OSError as e:
+                self.logger.error('Failed to remove match table: %s. Exception follows. %s', entry, e)
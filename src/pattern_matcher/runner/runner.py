@@ -1,41 +1,857 @@
 import time, sys, os
+import heapq
+import itertools
 import logging
 import glob
+import io
+import threading
+import concurrent.futures
+from collections import namedtuple
 import numpy as np
 import pandas as pd
 from ..loader import csv_loader as loader
+from .result_cache import ResultCache
+from .single_flight import SingleFlight
+from .snapshot import DatasetSnapshot
+from .match_table import MatchTableStore, data_fingerprint
+from . import columns as column_format
+from ..loader.packed import PackedDataset, PackedFrames, PublishedDataset, ChannelDataset, carried_bars, epoch_millis
+from ..loader.column_store import ColumnStore
+from ..loader.frame_cache import FrameCache, LazyFrames
+from ..processor.job import Job
+from ..processor.cancellation import CancellationToken
+from ..processor.scheduler import JobScheduler, DeadlineExpired
+from ..matcher.window_index import WindowIndex
+from ..matcher.pyramid import ResolutionPyramid
+from ..matcher.matcher import SpearmanMatcher, PearsonMatcher, VectorizedSpearmanMatcher, VectorizedPearsonMatcher, DTWMatcher, CombinedMatcher
+from ..measurements.spearmanr import BatchedSpearmanr
+from ..measurements.pearson import RollingPearson
+from ..measurements.banded_dtw import BandedDTW
+from ..processor.processor import MultiProcessingMeasurementProcessor, MultiThreadingMeasurementProcessor, PackedMeasurementProcessor, PooledMeasurementProcessor
+
+# what was read from a ticker file: stat at read time, bytes consumed, csv header and last row read
+FileState = namedtuple('FileState', ['mtime', 'size', 'offset', 'header', 'last_line', 'last_date'])
+
+class UnsupportedMeasure(Exception):
+    """ A request asked for a measure the runner cannot match with """
+    pass
+
+class UnsupportedChannel(UnsupportedMeasure):
+    """ A request asked for a channel the ticker files do not have """
+    pass
+
+class EventStream:
+    """
+    Iterator over the events of a streamed match. on_close runs once, when the events run out or fail
+    or when close() is called, whichever comes first, and also when no event was ever read, e.g. for
+    a HEAD request whose body the server never iterates. With acquire and release every event is
+    produced under a turn: the first is held by the caller, acquire() takes the next ones and returns
+    whether it got one, release() gives a turn back once its event is out, so a client reading slowly
+    holds none
+    """
+
+    def __init__(self, events, on_close=None, acquire=None, release=None):
+        self._events = events
+        self._on_close = on_close
+        self._acquire = acquire
+        self._release = release
+        self._held = release is not None
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._acquire is not None and not self._held:
+            held = self._acquire()
+            with self._lock:
+                self._held = held
+        try:
+            return next(self._events)
+        except BaseException:
+            self.close()
+            raise
+        finally:
+            self.give_back()
+
+    def give_back(self):
+        with self._lock:
+            held, self._held = self._held, False
+        if held:
+            self._release()
+
+    def close(self):
+        with self._lock:
+            on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+        self.give_back()
 
 class Runner():
     
-    _CACHE_DATA = dict()
+    _PACKED = False
+    _SHARED = False
     _DATA_PATH = None
     _TICKERS = None
     _FORMAT = None
     _CONCURRENCY = os.cpu_count()
+    _PER_TICKER = 1
+    _COMPACT = False
+    # bytes a chunked full scan may use for its working arrays, None scores the whole universe at once
+    _CHUNK_MEMORY = None
+    _MEASURE = None
+    # measures a request can ask for, several are scored together when joined by commas
+    _MEASURES = ('dtw', 'pearson', 'spearman')
+    # columns of the ticker files a pattern can span, close is always loaded and the others on first use
+    _CHANNELS = ('open', 'high', 'low', 'close', 'volume')
 
     def __init__(self, conf, logger=None):
         self.logger = logger or logging.getLogger(__name__)
         self.conf = conf
+        # the published data, replaced as a whole by loaders and never mutated
+        self._snapshot = DatasetSnapshot({})
+        self._file_state = dict()
+        self._load_lock = threading.Lock()
         self.init_runner(self.conf)
+        self._store = ColumnStore(conf['input']['cache_dir'], self._COMPACT) if conf['input'].get('cache_dir') else None
+        # bytes held for the universe, measured whenever a snapshot is published
+        self._memory = None
+        self._index_conf = conf.get('index', {}) if conf.get('index', {}).get('enabled', False) is True else None
+        if self._index_conf is not None and conf['measurement'].get('engine', 'vectorized') != 'vectorized':
+            raise Exception('Indexed matching requires the vectorized engine')
+        self._pyramid_conf = conf.get('pyramid', {}) if conf.get('pyramid', {}).get('enabled', False) is True else None
+        if self._pyramid_conf is not None and conf['measurement'].get('engine', 'vectorized') != 'vectorized':
+            raise Exception('Coarse-to-fine matching requires the vectorized engine')
+        self._processor = self.init_processor(self.conf)
+        # the channels are read into this process, their scans run in parts of the packed universe whatever the processor
+        self._channel_processor = self._processor if isinstance(self._processor, PackedMeasurementProcessor) else PackedMeasurementProcessor()
+        chunked_conf = conf['measurement'].get('chunked', {})
+        if chunked_conf.get('enabled', False) is True:
+            if not self._PACKED:
+                raise Exception('Chunked matching requires packed or pooled matching')
+            self._CHUNK_MEMORY = int(float(chunked_conf.get('memory_mb', 64)) * 2 ** 20)
+        # with lazy loading only the ticker list is read up front, frames are parsed on first use within a byte budget
+        lazy_conf = conf['input'].get('lazy', {})
+        self._frame_cache = None
+        if lazy_conf.get('enabled', False) is True:
+            if self._PACKED or self._SHARED or self._COMPACT or self._store is not None or self._index_conf is not None or self._pyramid_conf is not None:
+                raise Exception('Lazy loading requires multiprocessing matching of parsed frames, without a column store, index or pyramid')
+            self._frame_cache = FrameCache(int(float(lazy_conf.get('budget_mb', 512)) * 2 ** 20))
+        # {ticker: (mtime, size)} of the files behind lazily loaded frames
+        self._lazy_state = dict()
+        cache_conf = self.conf.get('cache', {})
+        self._result_cache = ResultCache(int(cache_conf.get('size', 256)), cache_conf.get('ttl'))
+        # identical requests arriving while a scan runs wait for it instead of scanning again
+        self._flights = SingleFlight()
+        self._precompute_conf = conf.get('precompute', {}) if conf.get('precompute', {}).get('enabled', False) is True else None
+        self._table_store = MatchTableStore(self._precompute_conf['dir']) if self._precompute_conf is not None else None
+        # the table survives restarts, it is only served while its fingerprint matches the data
+        self._table = self._table_store.load() if self._table_store is not None else None
+        self._fingerprint = (None, None)
+        self._precompute_lock = threading.Lock()
+        # {measure name: matcher}, built on the first request for the measure
+        self._matchers = dict()
+        self._matchers_lock = threading.Lock()
+        # {channel: (snapshot version, values parallel to the packed closes)}, read when a request first needs them
+        self._channels = dict()
+        self._channels_lock = threading.Lock()
+        # latest similarity per ticker, the scheduling order of anytime scans
+        self._priority = dict()
+        # every scan of every request takes its turn here, the processors never see more than running at once
+        scheduler_conf = conf.get('scheduler', {})
+        self._scheduler = JobScheduler(int(scheduler_conf.get('running') or self._CONCURRENCY), int(scheduler_conf.get('queue_size', 32)),
+                                       int(scheduler_conf.get('keep', 256)))
         self.get_all_tickers()
         self.load_data()
 
+    def snapshot(self):
+        return self._snapshot
+
+    def reload(self):
+        """ Re-read the data directory in place, keeping the processor and its workers alive """
+        with self._load_lock:
+            self.get_all_tickers()
+            self._file_state = dict()
+            self.load_data(rebuild=True)
+
+    def refresh(self):
+        """
+        Pick up rows appended to ticker files and new ticker files without re-parsing the others.
+        A file that was truncated or rewritten is parsed again in full. Returns the changed tickers
+        """
+        with self._load_lock:
+            return self.refresh_data()
+
+    def refresh_data(self):
+        if self._frame_cache is not None:
+            return self.refresh_lazy()
+        self.get_all_tickers()
+        snapshot = self._snapshot
+        updates, removed = self.collect_changes(snapshot.frames)
+        if updates or removed:
+            self.logger.info('Refreshing stock data of %s tickers ...', len(updates) + len(removed))
+            self.publish_changes(snapshot.packed, snapshot.frames, updates, removed, incremental=True)
+        return list(updates) + removed
+
+    def collect_changes(self, frames):
+        """ Parse what changed in the data directory since frames were read, as ({ticker: frame}, [removed tickers]) """
+        updates = dict()
+        for ticker in self._TICKERS:
+            state = self._file_state.get(ticker)
+            try:
+                stat = os.stat(self.ticker_path(ticker))
+                if state is not None and (stat.st_mtime, stat.st_size) == (state.mtime, state.size):
+                    continue
+                rows = self.read_appended(ticker, state) if state is not None and ticker in frames else None
+                if rows is None:
+                    updates[ticker] = self.read_ticker(ticker)
+                elif rows.shape[0] > 0:
+                    updates[ticker] = pd.concat([frames[ticker], rows], ignore_index=True)
+            except Exception as e:
+                self.logger.error('Failed to refresh data with ticker: %s, keeping loaded data. Exception follows. %s', ticker, e)
+        present = set(self._TICKERS)
+        removed = [ticker for ticker in frames if ticker not in present]
+        for ticker in removed:
+            self._file_state.pop(ticker, None)
+        return updates, removed
+
     def get_all_tickers(self):
         files = [f for f in glob.glob(self._DATA_PATH + '/*' + self._FORMAT, recursive=False)]
         self._TICKERS = [os.path.splitext(os.path.basename(file))[0].split('.')[0] for file in files]
+
+    def ticker_path(self, ticker):
+        return self._DATA_PATH + '/' + ticker + self._FORMAT
     
     def init_runner(self, conf):
         if conf['input']['dir']:
             self._DATA_PATH = conf['input']['dir']
             self._FORMAT = conf['input']['format']
             self._CONCURRENCY = int(conf['measurement']['concurrency'])
+            self._PER_TICKER = int(conf['measurement'].get('per_ticker', 1))
+            self._COMPACT = conf['input'].get('compact', False) is True
+            self._MEASURE = conf['measurement']['type'].lower()
+            if self._MEASURE not in self._MEASURES:
+                raise Exception('Unsupported measurement type: {}'.format(self._MEASURE))
+            if self._MEASURE == 'dtw' and conf['measurement'].get('engine', 'vectorized') != 'vectorized':
+                raise Exception('DTW measurement requires the vectorized engine')
+            if self._PER_TICKER > 1 and conf['measurement'].get('engine', 'vectorized') != 'vectorized':
+                raise Exception('Several matches per ticker require the vectorized engine')
         else:
             raise Exception('Unable to read conf: {}'.format('input'))
 
-    def run(self, ticker, days_back, days_forward, top):
-        pass
+    def init_processor(self, conf):
+        if conf['measurement'].get('packed', False) is True:
+            if conf['measurement'].get('engine', 'vectorized') != 'vectorized':
+                raise Exception('Packed matching requires the vectorized engine')
+            self._PACKED = True
+            return PackedMeasurementProcessor()
+        elif conf['measurement'].get('pool', False) is True:
+            if conf['measurement'].get('engine', 'vectorized') != 'vectorized':
+                raise Exception('Pooled matching requires the vectorized engine')
+            # each resident worker matches its shard as a packed dataset
+            self._PACKED = True
+            return PooledMeasurementProcessor(self._CONCURRENCY)
+        elif conf['measurement']['multiprocessing'] is True:
+            # workers map a dataset published once per load instead of unpickling every dataframe
+            self._SHARED = conf['measurement'].get('shared', False) is True and conf['measurement'].get('engine', 'vectorized') == 'vectorized'
+            return MultiProcessingMeasurementProcessor(self._CONCURRENCY)
+        elif conf['measurement']['threading'] is True:
+            return MultiThreadingMeasurementProcessor()
+        else:
+            raise Exception('Unable to read conf for processor type')
+
+    def run(self, ticker, days_back, days_forward, top, snapshot=None, token=None, columns=False, measure=None, channels=None):
+        """ Match the latest days_back bars of ticker, as the nested response or with columns as column_format.to_columns """
+        snapshot = snapshot if snapshot is not None else self.snapshot()
+        measure = self.measure_name(measure)
+        matcher = self.matcher(measure)
+        self.logger.info('Run pattern matching with ticker: %s - measurement: %s', ticker, matcher)
+        if ticker not in snapshot:
+            self.logger.info('Unsupported ticker exception: %s', ticker)
+            raise NameError('Failed to find ticker: {0}. Please provide the correct ticker'.format(ticker))
+
+        # load pattern data
+        pattern_close_values, pattern_date_values = self.pattern_values(snapshot, ticker, days_back)
+        channels = self.channel_patterns(snapshot, ticker, days_back, channels)
+
+        # create measurement job
+        job_name = measure + '-' + ticker + '-' + str(time.time())
+
+        # conduct a process and take the top results
+        top_results, complete = self.scan_until(snapshot, matcher, job_name, pattern_close_values, days_forward, top, token, channels)
+
+        # return results
+        return self.respond(ticker, pattern_close_values, pattern_date_values, top_results, complete, columns)
+
+    def pattern_values(self, snapshot, ticker, days_back):
+        """ (closes, dates) of the latest days_back bars of ticker, the pattern of a request """
+        pattern_dataframe = snapshot.frames[ticker]
+        pattern_size = len(pattern_dataframe)
+        pattern_date_values = pattern_dataframe.iloc[pattern_size - days_back:pattern_size, 0].to_list()
+        pattern_close_values = pattern_dataframe.iloc[pattern_size - days_back:pattern_size, 1].to_list()
+        return pattern_close_values, pattern_date_values
+
+    def measure_name(self, measure=None):
+        """
+        Canonical name of a requested measure: the conf's type when none is given, several measures
+        given as 'pearson,spearman' are sorted and deduplicated. Raises UnsupportedMeasure
+        """
+        if not measure:
+            return self._MEASURE
+        names = sorted(set(name.strip().lower() for name in measure.split(',')))
+        if any(name not in self._MEASURES for name in names):
+            raise UnsupportedMeasure('Unsupported measure: {0}'.format(measure))
+        vectorized = self.conf['measurement'].get('engine', 'vectorized') == 'vectorized'
+        if not vectorized and (len(names) > 1 or 'dtw' in names):
+            raise UnsupportedMeasure('Measure {0} requires the vectorized engine'.format(measure))
+        return ','.join(names)
+
+    def matcher(self, measure=None):
+        """ The matcher of a measure name as given by measure_name """
+        name = self.measure_name(measure)
+        with self._matchers_lock:
+            matcher = self._matchers.get(name)
+            if matcher is None:
+                matcher = self._matchers[name] = self.create_matcher(name)
+        return matcher
+
+    def create_matcher(self, name):
+        measurement_conf = self.conf['measurement']
+        chunk_size = int(measurement_conf.get('chunk_size', 4096))
+        exclusion = float(measurement_conf.get('exclusion', 1.0))
+        dtw_conf = measurement_conf.get('dtw', {})
+        if ',' in name:
+            # one sweep over the windows for every measure, dtw without its lower bound pruning
+            methods = {
+                'spearman': lambda: BatchedSpearmanr(chunk_size),
+                'pearson': lambda: RollingPearson(chunk_size),
+                'dtw': lambda: BandedDTW(float(dtw_conf.get('window', 0.1)))
+            }
+            return CombinedMatcher([methods[measure]() for measure in name.split(',')], chunk_size, self._PER_TICKER, exclusion)
+        vectorized = measurement_conf.get('engine', 'vectorized') == 'vectorized'
+        if name == 'spearman':
+            return VectorizedSpearmanMatcher(chunk_size, self._PER_TICKER, exclusion) if vectorized else SpearmanMatcher()
+        elif name == 'pearson':
+            return VectorizedPearsonMatcher(chunk_size, self._PER_TICKER, exclusion) if vectorized else PearsonMatcher()
+        elif name == 'dtw':
+            return DTWMatcher(float(dtw_conf.get('window', 0.1)), int(dtw_conf.get('batch_size', 256)), self._PER_TICKER, exclusion)
+        raise UnsupportedMeasure('Unsupported measure: {0}'.format(name))
+
+    def channel_names(self, channels=None):
+        """ Canonical name of requested channels: close when none are given, others sorted and deduplicated. Raises UnsupportedChannel """
+        if not channels:
+            return 'close'
+        names = sorted(set(name.strip().lower() for name in channels.split(',')))
+        if any(name not in self._CHANNELS for name in names):
+            raise UnsupportedChannel('Unsupported channel: {0}'.format(channels))
+        if names != ['close'] and self.conf['measurement'].get('engine', 'vectorized') != 'vectorized':
+            raise UnsupportedChannel('Channels {0} require the vectorized engine'.format(channels))
+        return ','.join(names)
+
+    def channel(self, snapshot, name):
+        """ Values of the name column of every ticker, parallel to snapshot.packed, read once per snapshot version """
+        if name == 'close':
+            return snapshot.packed.closes
+        with self._channels_lock:
+            version, values = self._channels.get(name, (None, None))
+            if version != snapshot.version:
+                begin_time = time.time()
+                values = self.read_channel(snapshot.packed, name)
+                self.logger.info('Loaded channel %s of %s tickers in %.3fs', name, len(snapshot.packed), time.time() - begin_time)
+                if snapshot.version == self._snapshot.version:
+                    self._channels[name] = (snapshot.version, values)
+        return values
+
+    def read_channel(self, packed, name, positions=None, values=None):
+        """
+        The name column of every ticker file aligned on the dates of packed, NaN where a file has no value.
+        With positions only those tickers are read, into values
+        """
+        values = np.full(packed.total_bars(), np.nan, dtype=packed.closes.dtype) if values is None else values
+        for i in (range(len(packed)) if positions is None else positions):
+            ticker = packed.tickers[i]
+            try:
+                df = self.to_epoch_millis(loader.load(self.ticker_path(ticker), delimiter=',', usecols=['date', name]))
+            except Exception as e:
+                self.logger.error('Failed to load channel %s of ticker: %s, it is not matched on it. Exception follows. %s', name, ticker, e)
+                continue
+            column = pd.Series(df[name].values, index=df['date'].values)
+            column = column[~column.index.duplicated(keep='last')]
+            values[packed.offsets[i]:packed.offsets[i + 1]] = column.reindex(epoch_millis(packed.series(ticker)[0])).values
+        return values
+
+    def channel_patterns(self, snapshot, ticker, days_back, channels=None):
+        """
+        (ChannelDataset, patterns, weights) of the latest days_back bars of ticker on every requested channel,
+        weighted by channels.weights of the conf. None for close alone, which is matched as before
+        """
+        channels = self.channel_names(channels)
+        if channels == 'close':
+            return None
+        if snapshot.packed is None:
+            raise UnsupportedChannel('Channels require packed data, not lazy loading')
+        weights = self.conf.get('channels', {}).get('weights', {})
+        i = snapshot.packed.position(ticker)
+        end = snapshot.packed.offsets[i + 1]
+        fr = max(snapshot.packed.offsets[i], end - days_back)
+        series = [self.channel(snapshot, name) for name in channels.split(',')]
+        return (ChannelDataset.of(snapshot.packed, series), [np.asarray(values[fr:end], dtype=np.float64) for values in series],
+                [float(weights.get(name, 1.0)) for name in channels.split(',')])
+
+    def match(self, ticker, days_back, days_forward, top, budget=None, columns=False, measure=None, channels=None):
+        """
+        run() behind the result cache and the precomputed table, results stay valid until the next load
+        bumps the version. budget, in seconds, defaults to measurement.budget_ms and includes the time
+        spent queued; a run cut short by it answers with complete set to False and is not cached.
+        Identical requests with the same budget arriving while the scan runs share its answer, complete
+        or not, so a follower never waits past its own deadline behind a longer running leader. columns
+        asks for the compact column_format response, measure a measure other than the conf's type and
+        channels, e.g. 'close,volume', the columns the pattern spans. Raises NameError for an unknown
+        ticker, UnsupportedMeasure for an unknown measure or channel and SchedulerBusy when the
+        scheduler's queue is full
+        """
+        snapshot = self._snapshot
+        key = (snapshot.version, ticker, days_back, days_forward, top, columns, self.measure_name(measure), self.channel_names(channels))
+        result = self.lookup(key, snapshot)
+        if result is None:
+            if ticker not in snapshot:
+                raise NameError('Data not found')
+            result = self._flights.do(key + (budget,), self.run_scheduled, key, snapshot, budget)
+        return result
+
+    def run_scheduled(self, key, snapshot, budget=None):
+        # the previous flight of key may have filled the cache since lookup()
+        result = self._result_cache.get(key)
+        if result is None:
+            token = self.token(budget)
+            job = Job('match {0}'.format(key[1]), self.run_cached, key, snapshot, token)
+            # the deadline includes the wait, a request that runs out in the queue is refused rather than scanned
+            result = self._scheduler.run(job, token=token)
+        return result
+
+    def lookup(self, key, snapshot):
+        """ The cached or precomputed answer of key, None when the scan has to run """
+        _, ticker, days_back, days_forward, top, columns, measure, channels = key
+        result = self._result_cache.get(key)
+        if result is None and measure == self._MEASURE and channels == 'close':
+            # the table is built with the conf's measure on closes
+            result = self.precomputed(snapshot, ticker, days_back, days_forward, top)
+            if result is not None:
+                result = column_format.from_response(result) if columns else result
+                self._result_cache.put(key, result)
+        return result
+
+    def run_cached(self, key, snapshot, token=None):
+        _, ticker, days_back, days_forward, top, columns, measure, channels = key
+        result = self.run(ticker, days_back, days_forward, top, snapshot, token, columns, measure, channels)
+        if result.get('complete', True):
+            self._result_cache.put(key, result)
+        return result
+
+    def submit_match(self, ticker, days_back, days_forward, top, budget=None, measure=None, channels=None):
+        """
+        match() in the background for long scans, returns the Job to poll with job(). Only a budget
+        given here limits the scan. Raises NameError for an unknown ticker, UnsupportedMeasure for an
+        unknown measure and SchedulerBusy when the queue is full
+        """
+        snapshot = self._snapshot
+        if ticker not in snapshot:
+            raise NameError('Data not found')
+        key = (snapshot.version, ticker, days_back, days_forward, top, False, self.measure_name(measure), self.channel_names(channels))
+        token = CancellationToken(budget) if budget is not None else None
+        job = Job('match {0}'.format(ticker), self.run_cached, key, snapshot, token)
+        result = self.lookup(key, snapshot)
+        if result is not None:
+            return self._scheduler.record(job, result)
+        return self._scheduler.submit(job, token)
+
+    def job(self, job_id):
+        """ State of a submitted job as json, with its response once done. None for an unknown or forgotten id """
+        job = self._scheduler.get(job_id)
+        if job is None:
+            return None
+        state = {
+            'id': job.id,
+            'status': job.status,
+            'submitted': job.submitted,
+            'started': job.started,
+            'finished': job.finished
+        }
+        if job.status == 'queued':
+            state['position'] = self._scheduler.position(job)
+        elif job.status == 'done':
+            state['result'] = job.result
+        elif job.status == 'failed':
+            state['error'] = job.error
+        return state
+
+    def token(self, budget=None):
+        """ CancellationToken of a request, None when neither the request nor the conf sets a budget """
+        if budget is None and self.conf['measurement'].get('budget_ms') is not None:
+            budget = float(self.conf['measurement']['budget_ms']) / 1000.
+        return CancellationToken(budget) if budget is not None else None
+
+    def match_stream(self, ticker, days_back, days_forward, top, budget=None, measure=None, channels=None):
+        """
+        match() as events: progress events with the running top matches while the scan runs, then a
+        result event with the response. A cached or precomputed answer is sent as the result event alone.
+        Raises NameError for an unknown ticker, UnsupportedMeasure for an unknown measure and SchedulerBusy
+        when the queue is full, or DeadlineExpired when the budget runs out in it, before any event is
+        produced. The scan takes a turn for every event and gives it back while the client reads it,
+        closing the EventStream early cancels the scan
+        """
+        snapshot = self._snapshot
+        measure, channels = self.measure_name(measure), self.channel_names(channels)
+        key = (snapshot.version, ticker, days_back, days_forward, top, False, measure, channels)
+        result = self.lookup(key, snapshot)
+        if result is not None:
+            return EventStream(iter([dict(result, event='result')]))
+        if ticker not in snapshot:
+            raise NameError('Data not found')
+        token = self.token(budget) or CancellationToken()
+        job = Job('stream {0}'.format(ticker), None)
+        self._scheduler.admit(job, token)
+        try:
+            events = self.run_stream(ticker, days_back, days_forward, top, snapshot, token, measure, channels)
+        except Exception:
+            self._scheduler.release(job)
+            raise
+        cached = self.cache_stream(key, events)
+
+        def acquire():
+            # the stream queues behind the requests that came in meanwhile, but is never refused
+            try:
+                self._scheduler.admit(job, token, reject=False)
+                return True
+            except DeadlineExpired:
+                # the token stops the scan, the events left cost nothing
+                return False
+
+        def close():
+            # the client went away, or the stream ended. Cleaned up here rather than in a finally of the
+            # generators, those never run for a stream nobody starts reading
+            token.cancel()
+            cached.close()
+            events.close()
+        return EventStream(cached, close, acquire, lambda: self._scheduler.release(job))
+
+    def cache_stream(self, key, events):
+        for event in events:
+            if event['event'] == 'result' and event.get('complete', True):
+                self._result_cache.put(key, {name: value for name, value in event.items() if name != 'event'})
+            yield event
+
+    def run_stream(self, ticker, days_back, days_forward, top, snapshot, token=None, measure=None, channels=None):
+        """ Events of the match as the processor finishes parts of the universe """
+        if ticker not in snapshot:
+            self.logger.info('Unsupported ticker exception: %s', ticker)
+            raise NameError('Failed to find ticker: {0}. Please provide the correct ticker'.format(ticker))
+
+        pattern_close_values, pattern_date_values = self.pattern_values(snapshot, ticker, days_back)
+        job_name = self.measure_name(measure) + '-stream-' + ticker + '-' + str(time.time())
+        channels = self.channel_patterns(snapshot, ticker, days_back, channels)
+        parts = self.scan_iter(snapshot, self.matcher(measure), job_name, pattern_close_values, days_forward, top, token, channels)
+        return self.stream(ticker, pattern_close_values, pattern_date_values, parts, top)
+
+    def match_batch(self, requests):
+        """
+        Answer a list of {'ticker', 'days_back', 'days_forward', 'top'} requests, each with an optional
+        'measure' and 'channels', in one call. Requests sharing days_back, days_forward, measure and
+        channels are matched together in one pass over the data, each answer
+        is a match response or {'error': message}, in request order. The batch takes one turn of the
+        scheduler and raises SchedulerBusy when its queue is full
+        """
+        return self._scheduler.run(Job('batch of {0}'.format(len(requests)), self.answer_batch, requests))
+
+    def answer_batch(self, requests):
+        snapshot = self._snapshot
+        answers = [None] * len(requests)
+        groups = dict()
+        for position, request in enumerate(requests):
+            try:
+                ticker, days_back, days_forward, top = request['ticker'].upper(), int(request['days_back']), int(request['days_forward']), int(request['top'])
+                measure, channels = self.measure_name(request.get('measure')), self.channel_names(request.get('channels'))
+            except (KeyError, TypeError, ValueError, AttributeError, UnsupportedMeasure) as e:
+                answers[position] = {'error': 'Invalid request: {0}'.format(e)}
+                continue
+            if ticker not in snapshot:
+                answers[position] = {'error': 'Data not found'}
+                continue
+            key = (snapshot.version, ticker, days_back, days_forward, top, False, measure, channels)
+            result = self.lookup(key, snapshot)
+            if result is not None:
+                answers[position] = result
+            else:
+                groups.setdefault((days_back, days_forward, measure, channels), []).append((position, ticker, top, key))
+
+        for (days_back, days_forward, measure, channels), members in groups.items():
+            self.logger.info('Batch matching %s patterns of %s days back, %s days forward with %s on %s', len(members), days_back, days_forward, measure, channels)
+            responses = self.run_batch([ticker for _, ticker, _, _ in members], days_back, days_forward, [top for _, _, top, _ in members], snapshot, measure, channels)
+            for (position, _, _, key), response in zip(members, responses):
+                answers[position] = response
+                if 'error' not in response:
+                    self._result_cache.put(key, response)
+        return answers
+
+    def run_batch(self, tickers, days_back, days_forward, tops, snapshot, measure=None, channels=None):
+        """ Match the latest days_back bars of every ticker in one pass over the data """
+        measure = self.measure_name(measure)
+        patterns = [self.pattern_values(snapshot, ticker, days_back) for ticker in tickers]
+        close_patterns = [close_values for close_values, _ in patterns]
+        vectorized = self.conf['measurement'].get('engine', 'vectorized') == 'vectorized'
+        if (not vectorized or measure == 'dtw' or self.channel_names(channels) != 'close'
+                or any(len(close_values) != days_back for close_values in close_patterns)):
+            # loop matchers score one pattern at a time, dtw prunes its search per pattern, channels take one
+            # pass per pattern and a ticker shorter than days_back gives a shorter pattern: match those one by one
+            return self.run_each(tickers, days_back, days_forward, tops, snapshot, measure, channels)
+
+        job_name = measure + '-batch-' + str(len(tickers)) + '-' + str(time.time())
+        all_results = self.scan_batch(snapshot, self.matcher(measure), job_name, close_patterns, days_forward, tops)
+
+        responses = []
+        for ticker, (pattern_close_values, pattern_date_values), top_results in zip(tickers, patterns, all_results):
+            try:
+                responses.append(self.convert_to_json(ticker, pattern_close_values, pattern_date_values, top_results))
+            except Exception as e:
+                self.logger.error('Failed to match %s in batch. Exception follows. %s', ticker, e)
+                responses.append({'error': 'Failed to match: {0}'.format(e)})
+        return responses
+
+    def run_each(self, tickers, days_back, days_forward, tops, snapshot, measure=None, channels=None):
+        """ run_batch one request at a time, one response per ticker """
+        responses = []
+        for ticker, top in zip(tickers, tops):
+            try:
+                responses.append(self.run(ticker, days_back, days_forward, top, snapshot, measure=measure, channels=channels))
+            except Exception as e:
+                self.logger.error('Failed to match %s in batch. Exception follows. %s', ticker, e)
+                responses.append({'error': 'Failed to match: {0}'.format(e)})
+        return responses
+
+    def fingerprint(self, snapshot):
+        version, fingerprint = self._fingerprint
+        if version != snapshot.version:
+            fingerprint = data_fingerprint(snapshot, self.conf['measurement'])
+            self._fingerprint = (snapshot.version, fingerprint)
+        return fingerprint
+
+    def precomputed(self, snapshot, ticker, days_back, days_forward, top):
+        """ The precomputed table's answer, None when there is no table, no entry or the data changed since it was built """
+        table = self._table
+        if table is None or table.fingerprint != self.fingerprint(snapshot):
+            return None
+        return table.get(ticker, days_back, days_forward, top)
+
+    def precompute(self):
+        """
+        Match every ticker's latest days_back bars for each configured days_back/days_forward and
+        write the answers as the new match table. Returns a summary with the wall-clock time
+        """
+        if self._precompute_conf is None:
+            raise Exception('Precomputed matching is not enabled')
+        with self._precompute_lock:
+            begin = time.time()
+            snapshot = self._snapshot
+            top = int(self._precompute_conf.get('top', 20))
+            keys = [(ticker, int(days_back), int(days_forward)) for ticker in sorted(snapshot.tickers)
+                    for days_back in self._precompute_conf.get('days_back', [30, 60, 90])
+                    for days_forward in self._precompute_conf.get('days_forward', [10, 30])]
+
+            def answer(key):
+                try:
+                    # the nightly build queues behind requests like any other job, but is never refused
+                    job = Job('precompute {0}'.format(key[0]), self.run, key[0], key[1], key[2], top, snapshot)
+                    return key, self._scheduler.run(job, reject=False)
+                except Exception as e:
+                    self.logger.error('Failed to precompute %s. Exception follows. %s', key, e)
+                    return key, None
+
+            # packed and pooled requests run in one process or on resident workers, so requests are run
+            # side by side on all cores; the other processors already fan every request out
+            workers = self._CONCURRENCY if self._PACKED else 1
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                entries = [(key, response) for key, response in executor.map(answer, keys) if response is not None]
+            elapsed = time.time() - begin
+            meta = {'built_at': begin, 'seconds': elapsed, 'version': snapshot.version}
+            self._table = self._table_store.write(self.fingerprint(snapshot), top, entries, meta)
+            self.logger.info('Precomputed %s of %s matches in %.1f seconds', len(entries), len(keys), elapsed)
+            return {'entries': len(entries), 'requested': len(keys), 'seconds': elapsed}
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            'version': snapshot.version,
+            'tickers': len(snapshot),
+            'cache': self._result_cache.stats(),
+            'precomputed': self.table_stats(snapshot),
+            'memory': self._frame_cache.stats() if self._frame_cache is not None else self._memory,
+            'channels': self.channel_stats(snapshot),
+            'scheduler': self._scheduler.stats(),
+            'coalesced': self._flights.stats()
+        }
+
+    def channel_stats(self, snapshot):
+        """ Bytes of every channel loaded for the snapshot besides closes """
+        with self._channels_lock:
+            return {name: int(values.nbytes) for name, (version, values) in self._channels.items() if version == snapshot.version}
+
+    def table_stats(self, snapshot):
+        table = self._table
+        if table is None:
+            return None
+        return {
+            'entries': len(table),
+            'top': table.top,
+            'current': table.fingerprint == self.fingerprint(snapshot),
+            'built_at': table.meta.get('built_at'),
+            'seconds': table.meta.get('seconds')
+        }
+
+    def scan(self, snapshot, matcher, job_name, pattern_close_values, days_forward, top):
+        """ Match the pattern against the snapshot and return the top results by descending similarity """
+        return self.scan_until(snapshot, matcher, job_name, pattern_close_values, days_forward, top)[0]
+
+    def scan_until(self, snapshot, matcher, job_name, pattern_close_values, days_forward, top, token=None, channels=None):
+        """
+        scan() under a CancellationToken, returns the top results and whether every ticker was matched.
+        channels, as given by channel_patterns, matches the pattern on several columns of the packed data
+        """
+        if channels is not None and token is None:
+            data, meas_job = self.channel_job(matcher, job_name, days_forward, top, channels)
+            results, complete = self._channel_processor.process(data, meas_job, self._CONCURRENCY), True
+        elif channels is None and self.narrowed(snapshot, len(pattern_close_values)):
+            starts = self.candidates(snapshot, pattern_close_values)
+            self.logger.info('Verifying %s candidates for job: %s', starts.shape[0], job_name)
+            results, complete = matcher.match_candidates(time.time(), snapshot.packed, starts, pattern_close_values, days_forward, top), True
+        elif token is None:
+            data, meas_job = self.scan_job(snapshot, matcher, job_name, pattern_close_values, days_forward, top)
+            results, complete = self.flatten(self._processor.process(data, meas_job, self._CONCURRENCY)), True
+        else:
+            results, complete = [], False
+            for done, total, part in self.scan_iter(snapshot, matcher, job_name, pattern_close_values, days_forward, top, token, channels):
+                results.extend(part)
+                complete = done == total
+            if not complete:
+                self.logger.info('Returning partial results of job: %s', job_name)
+        self.remember(results)
 
-    def convert_to_json(self, ticker, pattern_close_values, pattern_date_values, predict):
+        # keep the top results in a bounded heap, ties in arrival order like a stable sort
+        return heapq.nlargest(top, results, key=lambda x: x[1]), complete
+
+    def scan_iter(self, snapshot, matcher, job_name, pattern_close_values, days_forward, top, token=None, channels=None):
+        """ scan() as a generator of (done, total, results) as the processor finishes parts of the universe, results unsorted """
+        if channels is not None:
+            data, meas_job = self.channel_job(matcher, job_name, days_forward, top, channels)
+            for part in self._channel_processor.process_iter(data, meas_job, self._CONCURRENCY, token, self._priority):
+                yield part
+            return
+        if self.narrowed(snapshot, len(pattern_close_values)):
+            yield 1, 1, self.scan_until(snapshot, matcher, job_name, pattern_close_values, days_forward, top)[0]
+            return
+        data, meas_job = self.scan_job(snapshot, matcher, job_name, pattern_close_values, days_forward, top)
+        for done, total, results in self._processor.process_iter(data, meas_job, self._CONCURRENCY, token, self._priority):
+            yield done, total, self.flatten(results)
+
+    def narrowed(self, snapshot, window_size):
+        """ Whether patterns of window_size are answered from candidates instead of a full scan """
+        return window_size in snapshot.indexes or (snapshot.pyramid is not None and snapshot.pyramid.covers(window_size))
+
+    def candidates(self, snapshot, pattern_close_values):
+        """ Window starts to verify exactly: the SAX index of the pattern's length, else the resolution pyramid """
+        index = snapshot.indexes.get(len(pattern_close_values))
+        if index is not None:
+            # the windows whose SAX words are closest to the pattern
+            return index.candidates(pattern_close_values, int(self._index_conf.get('candidates', 5000)))
+        # the bars around the best regions of the downsampled levels
+        return snapshot.pyramid.candidates(pattern_close_values)
+
+    def remember(self, results):
+        """ Keep the latest similarity of every matched ticker, processors schedule the best ones first next time """
+        for result in results:
+            self._priority[result[0]] = result[1]
+
+    def scan_job(self, snapshot, matcher, job_name, pattern_close_values, days_forward, top):
+        """ The data and the job of a full scan """
+        if self._PACKED and self._CHUNK_MEMORY is not None:
+            # the same ranking in chunks of windows, for histories too long to score at once
+            return snapshot.packed, Job(job_name, matcher.match_chunked, pattern_close_values, days_forward, 1, top, self._CHUNK_MEMORY)
+        elif self._PACKED:
+            # the packed matcher ranks the whole universe itself and only builds the top results
+            return snapshot.packed, Job(job_name, matcher.match_packed, pattern_close_values, days_forward, 1, top)
+        elif self._SHARED:
+            return snapshot.shared, Job(job_name, matcher.match_shared_top if self._PER_TICKER > 1 else matcher.match_shared, pattern_close_values, days_forward, 1)
+        return snapshot.frames, Job(job_name, matcher.match_top if self._PER_TICKER > 1 else matcher.match, pattern_close_values, days_forward, 1)
+
+    def channel_job(self, matcher, job_name, days_forward, top, channels):
+        """ The data and the job of a scan over the channels given by channel_patterns """
+        data, patterns, weights = channels
+        self.logger.info('Matching %s channels for job: %s', len(patterns), job_name)
+        return data, Job(job_name, matcher.match_channels, patterns, weights, days_forward, 1, top)
+
+    def flatten(self, results):
+        if self._PER_TICKER > 1 and not self._PACKED:
+            # per ticker jobs returned lists of windows
+            return [result for windows in results for result in windows]
+        return results
+
+    def stream(self, ticker, pattern_close_values, pattern_date_values, parts, top):
+        """
+        Turn the (done, total, results) parts of scan_iter into progress events carrying the running
+        top matches, then a result event with the final response. Only top results are ever held
+        """
+        # min-heap on (similarity, -arrival), earlier arrivals win ties like the stable sort in scan
+        heap, arrivals, complete = [], itertools.count(), False
+        for done, total, results in parts:
+            self.remember(results)
+            complete = done == total
+            changed = False
+            for result in results:
+                item = (result[1], -next(arrivals), result)
+                if len(heap) < top:
+                    heapq.heappush(heap, item)
+                    changed = True
+                elif item[:2] > heap[0][:2]:
+                    heapq.heapreplace(heap, item)
+                    changed = True
+            if changed or done == total:
+                ranking = [item[2] for item in sorted(heap, key=lambda item: item[:2], reverse=True)]
+                yield {'event': 'progress', 'done': done, 'total': total, 'matches': {rank: self.convert_match(item) for rank, item in enumerate(ranking, 1)}}
+
+        ranking = [item[2] for item in sorted(heap, key=lambda item: item[:2], reverse=True)]
+        try:
+            response = self.convert_to_json(ticker, pattern_close_values, pattern_date_values, ranking, complete)
+        except Exception as e:
+            self.logger.error('Failed to build the response of %s. Exception follows. %s', ticker, e)
+            yield {'event': 'error', 'error': 'Failed to match: {0}'.format(e)}
+            return
+        response['event'] = 'result'
+        yield response
+
+    def scan_batch(self, snapshot, matcher, job_name, patterns, days_forward, tops):
+        """ scan() for several patterns of the same length, one list of top results per pattern """
+        if self.narrowed(snapshot, len(patterns[0])):
+            # candidates differ per pattern, they already avoid the full pass
+            return [self.scan(snapshot, matcher, job_name, pattern, days_forward, top) for pattern, top in zip(patterns, tops)]
+        if self._PACKED:
+            meas_job = Job(job_name, matcher.match_packed_many, patterns, days_forward, 1, max(tops))
+            pairs = self._processor.process(snapshot.packed, meas_job, self._CONCURRENCY)
+        else:
+            meas_job = Job(job_name, matcher.match_shared_many if self._SHARED else matcher.match_many, patterns, days_forward, 1)
+            pairs = self._processor.process(snapshot.shared if self._SHARED else snapshot.frames, meas_job, self._CONCURRENCY)
+            # per ticker jobs returned lists of pairs
+            pairs = [pair for ticker_pairs in pairs for pair in ticker_pairs]
+
+        results = [[] for _ in patterns]
+        for position, result in pairs:
+            results[position].append(result)
+        return [heapq.nlargest(top, found, key=lambda x: x[1]) for found, top in zip(results, tops)]
+
+    def respond(self, ticker, pattern_close_values, pattern_date_values, predict, complete=True, columns=False):
+        if columns:
+            return column_format.to_columns(ticker, pattern_close_values, pattern_date_values, predict, complete)
+        return self.convert_to_json(ticker, pattern_close_values, pattern_date_values, predict, complete)
+
+    def convert_to_json(self, ticker, pattern_close_values, pattern_date_values, predict, complete=True):
         # Initialize origin
         origin = {
             'ticker': ticker,
@@ -48,9 +864,11 @@ class Runner():
         for day_no, time in enumerate(origin['time']):
             history_time_set[day_no+1] = [time,]
         # 1st (arbitrary) item in prediction, [2][3] => future_time
-        for day_no, _ in enumerate(predict[0][2][3]):
+        for day_no, _ in enumerate(predict[0][2][3] if predict else []):
             future_time_set[day_no+1] = []
 
+        # vectorized matchers return numpy slices
+        predict = [(item[0], item[1], tuple(as_list(values) for values in item[2])) + tuple(item[3:]) for item in predict]
         for day_no, item in enumerate(predict):
             # Update time set
             for index, history_time in enumerate(item[2][1]):
@@ -58,29 +876,254 @@ class Runner():
             for index, future_time in enumerate(item[2][3]):
                 future_time_set[index+1].append(future_time)
 
-            matches[day_no+1] = {
-                'ticker': item[0],
-                'similarity': item[1],
-                'history': item[2][0],
-                'hitory_time': item[2][1],
-                'future': item[2][2],
-                'future_time': item[2][3]
-            }
+            matches[day_no+1] = self.convert_match(item)
         return {
             'origin': origin,
             'history_time_set': history_time_set,
             'future_time_set': future_time_set,
-            'matches': matches
+            'matches': matches,
+            # False when a deadline or a cancellation cut the scan short
+            'complete': complete
         }
 
-    def load_data(self):
+    def convert_match(self, item):
+        return {
+            'ticker': item[0],
+            'similarity': item[1],
+            'history': as_list(item[2][0]),
+            'hitory_time': as_list(item[2][1]),
+            'future': as_list(item[2][2]),
+            'future_time': as_list(item[2][3])
+        }
+
+    def load_data(self, rebuild=False):
+        if self._frame_cache is not None:
+            return self.load_lazy()
+        if self._store is not None:
+            return self.load_store(rebuild)
         self.logger.info('Loading stock data ...')
+        frames = dict()
         for ticker in self._TICKERS:
             try:
-                df = loader.load(self._DATA_PATH + '/' + ticker + self._FORMAT, delimiter=',', usecols=['date', 'close'])
-                df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d').astype('int64')
-                df['date'] = df['date'] // int(10 ** 6)
-                self._CACHE_DATA[ticker] = df
+                frames[ticker] = self.read_ticker(ticker)
             except Exception as e:
                 self.logger.error('Failed to load data with ticker: %s. Exception follows. %s', ticker, e)
-                raise Exception('Failed to load data: {0}. Exception follows. {1}'.format(ticker, e))
\ No newline at end of file
+                raise Exception('Failed to load data: {0}. Exception follows. {1}'.format(ticker, e))
+        packed = PackedDataset.from_frames(frames, self._COMPACT)
+        # a compact runner keeps only the packed arrays, frames are built from them on access
+        self.publish_data(PackedFrames(packed) if self._COMPACT else frames, packed)
+
+    def load_store(self, rebuild=False):
+        """ Map the column store and parse only the sources that changed since it was written """
+        packed, sources = (None, dict()) if rebuild else self._store.load()
+        frames = PackedFrames(packed) if packed is not None else dict()
+        self._file_state = {ticker: state_from_json(state) for ticker, state in sources.items()}
+        self.logger.info('Loading stock data from column store %s with %s stored tickers ...', self._store.directory, len(frames))
+        updates, removed = self.collect_changes(frames)
+        if packed is None or updates or removed:
+            self.publish_changes(packed, frames, updates, removed)
+        else:
+            self.publish_data(frames, packed)
+
+    def load_lazy(self):
+        """ Publish the ticker list alone, every frame is parsed when a request first needs it """
+        self.logger.info('Discovered %s tickers, loading them on first use within %s bytes', len(self._TICKERS), self._frame_cache.budget)
+        self._frame_cache.clear()
+        self._lazy_state = self.lazy_state()
+        self.publish_lazy()
+
+    def refresh_lazy(self):
+        """ Drop the frames of changed or removed files and publish a new version when anything changed """
+        self.get_all_tickers()
+        state = self.lazy_state()
+        changed = [ticker for ticker in state if state[ticker] != self._lazy_state.get(ticker)]
+        changed += [ticker for ticker in self._lazy_state if ticker not in state]
+        if changed:
+            self.logger.info('Refreshing stock data of %s tickers ...', len(changed))
+            self._frame_cache.discard(changed)
+            self._lazy_state = state
+            self.publish_lazy()
+        return changed
+
+    def lazy_state(self):
+        state = dict()
+        for ticker in self._TICKERS:
+            try:
+                stat = os.stat(self.ticker_path(ticker))
+                state[ticker] = (stat.st_mtime, stat.st_size)
+            except OSError as e:
+                self.logger.error('Failed to stat ticker: %s, leaving it out. Exception follows. %s', ticker, e)
+        return state
+
+    def publish_lazy(self):
+        version = self._snapshot.version + 1
+        frames = LazyFrames(sorted(self._lazy_state), self._frame_cache, self.read_ticker)
+        self._snapshot = DatasetSnapshot(frames, None, None, version)
+        self._result_cache.clear()
+
+    def publish_changes(self, packed, frames, updates, removed, incremental=False):
+        """
+        Apply parsed updates and removals on top of packed/frames and publish the result. incremental when
+        packed is the current snapshot's, what derives from the unchanged tickers is then carried over
+        """
+        changed = list(updates) + list(removed) if incremental else None
+        if self._store is None and not self._COMPACT:
+            frames = dict(frames)
+            frames.update(updates)
+            for ticker in removed:
+                frames.pop(ticker)
+            return self.publish_data(frames, PackedDataset.from_frames(frames), changed)
+
+        removed = set(removed)
+        tickers = [ticker for ticker in (packed.tickers if packed is not None else []) if ticker not in removed]
+        tickers += [ticker for ticker in updates if packed is None or ticker not in packed]
+        def series(ticker):
+            if ticker in updates:
+                return updates[ticker].iloc[:, 0].values, updates[ticker].iloc[:, 1].values
+            return packed.series(ticker)
+        if self._store is None:
+            packed = PackedDataset.from_series(tickers, series, True)
+        else:
+            sources = {ticker: state_to_json(self._file_state[ticker]) for ticker in tickers}
+            packed = self._store.write(tickers, series, sources)
+        self.publish_data(PackedFrames(packed), packed, changed)
+
+    def publish_data(self, frames, packed, changed=None):
+        """
+        Build the next snapshot from frames and packed, hand it to the processor and swap it in. changed,
+        the tickers a refresh re-read or removed, lets the processor, the indexes, the pyramid and the
+        channels keep what they hold for the other tickers of the current snapshot
+        """
+        previous = self._snapshot
+        if previous.packed is None:
+            changed = None
+        version = previous.version + 1
+        packed.version = version
+        self._memory = self.memory_usage(frames, packed)
+        self.logger.info('Packed %s tickers, %s bars, holding %s bytes', len(packed), packed.total_bars(), self._memory['total'])
+        shared = None
+        if self._SHARED and self._store is not None:
+            # workers can map the column store itself, the store keeps the files of in-flight versions
+            shared = PublishedDataset(self._store.current(), packed.tickers)
+        elif self._SHARED:
+            shared = packed.publish(self.conf['input'].get('shared_dir'))
+        self._processor.load(packed, changed)
+        indexes = self.build_indexes(packed, previous, changed)
+        pyramid = self.build_pyramid(packed, previous, changed)
+        channels = self.carry_channels(packed, version, previous, changed)
+        with self._channels_lock:
+            # other channels of the previous version are read again on their next use
+            self._channels = channels
+        self._snapshot = DatasetSnapshot(frames, packed, shared, version, indexes, pyramid)
+        self._result_cache.clear()
+
+    def carry_channels(self, packed, version, previous, changed=None):
+        """ {channel: (version, values)} of packed from the channels read for previous, reading only the changed tickers again """
+        if changed is None:
+            return dict()
+        with self._channels_lock:
+            channels = {name: values for name, (channel_version, values) in self._channels.items() if channel_version == previous.version}
+        kept, fresh = carried_bars(previous.packed, packed, changed)
+        carried = dict()
+        for name, values in channels.items():
+            moved = np.full(packed.total_bars(), np.nan, dtype=values.dtype)
+            for i, j in kept:
+                moved[packed.offsets[i]:packed.offsets[i + 1]] = values[previous.packed.offsets[j]:previous.packed.offsets[j + 1]]
+            carried[name] = (version, self.read_channel(packed, name, fresh, moved))
+        return carried
+
+    def memory_usage(self, frames, packed):
+        """ Bytes of the per-ticker frames, unless they are views of packed, and of the packed arrays """
+        frame_bytes = 0 if isinstance(frames, PackedFrames) else int(sum(sys.getsizeof(frame) for frame in frames.values()))
+        return {
+            'frames': frame_bytes,
+            'packed': packed.nbytes(),
+            'total': frame_bytes + packed.nbytes(),
+            'bars': packed.total_bars(),
+            'compact': packed.closes.dtype == np.float32
+        }
+
+    def build_indexes(self, packed, previous=None, changed=None):
+        if self._index_conf is None:
+            return dict()
+        begin_time = time.time()
+        indexes = dict()
+        for length in self._index_conf.get('lengths', []):
+            index = WindowIndex(int(length), int(self._index_conf.get('segments', 8)), int(self._index_conf.get('alphabet', 4)))
+            current = previous.indexes.get(int(length)) if changed is not None else None
+            indexes[int(length)] = index.update(packed, previous.packed, current, changed) if current is not None else index.build(packed)
+        self.logger.info('Built window indexes for lengths %s in %.3fs', sorted(indexes), time.time() - begin_time)
+        return indexes
+
+    def build_pyramid(self, packed, previous=None, changed=None):
+        if self._pyramid_conf is None:
+            return None
+        begin_time = time.time()
+        pyramid = ResolutionPyramid(self._pyramid_conf.get('factors', [21, 5]), int(self._pyramid_conf.get('regions', 2000)),
+                                    int(self._pyramid_conf.get('per_ticker', 10)))
+        if changed is not None and previous.pyramid is not None:
+            pyramid.update(packed, previous.packed, previous.pyramid, changed)
+        else:
+            pyramid.build(packed)
+        self.logger.info('Built resolution pyramid in %.3fs', time.time() - begin_time)
+        return pyramid
+
+    def read_ticker(self, ticker):
+        """ Parse the complete rows of a ticker file and remember how far it was read """
+        with open(self.ticker_path(ticker), 'rb') as f:
+            stat = os.fstat(f.fileno())
+            content = f.read()
+        # like read_appended, a last row without its newline may still be being written and waits for the next refresh
+        content = content[:content.rfind(b'\n') + 1]
+        df = self.to_epoch_millis(loader.load(io.BytesIO(content), delimiter=',', usecols=['date', 'close']))
+        header = content[:content.find(b'\n')].decode('utf-8').strip().split(',')
+        last_date = df.iloc[-1, 0] if df.shape[0] > 0 else None
+        self._file_state[ticker] = FileState(stat.st_mtime, stat.st_size, len(content), header, last_line(content), last_date)
+        return df
+
+    def read_appended(self, ticker, state):
+        """
+        Parse only the complete rows written after state.offset.
+        Returns None when the file no longer continues what was read, so it has to be parsed again
+        """
+        with open(self.ticker_path(ticker), 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size < state.offset:
+                return None
+            f.seek(state.offset - len(state.last_line))
+            content = f.read()
+        if not content.startswith(state.last_line):
+            return None
+        content = content[len(state.last_line):]
+        # leave a row the collector is still writing for the next refresh
+        end = content.rfind(b'\n') + 1
+        if end == 0:
+            self._file_state[ticker] = state._replace(mtime=stat.st_mtime, size=stat.st_size)
+            return pd.DataFrame(columns=['date', 'close'])
+
+        rows = self.to_epoch_millis(loader.load(io.BytesIO(content[:end]), delimiter=',', usecols=['date', 'close'], header=None, names=state.header))
+        if state.last_date is not None and rows.iloc[0, 0] <= state.last_date:
+            return None
+        self._file_state[ticker] = FileState(stat.st_mtime, stat.st_size, state.offset + end, state.header, last_line(content[:end]), rows.iloc[-1, 0])
+        return rows
+
+    @staticmethod
+    def to_epoch_millis(df):
+        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d').astype('int64')
+        df['date'] = df['date'] // int(10 ** 6)
+        return df
+
+def as_list(values):
+    return values.tolist() if isinstance(values, np.ndarray) else values
+
+def state_to_json(state):
+    return [state.mtime, state.size, state.offset, state.header, state.last_line.decode('latin-1'),
+            None if state.last_date is None else int(state.last_date)]
+
+def state_from_json(state):
+    return FileState(state[0], state[1], state[2], state[3], state[4].encode('latin-1'), state[5])
+
+def last_line(content):
+    """ Last newline-terminated line of content, including its newline """
+    end = content.rfind(b'\n', 0, len(content) - 1) + 1
+    return content[end:]
@@ -0,0 +1,46 @@
+import threading
+from concurrent.futures import Future
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller computes, callers arriving
+    while it runs wait on the same future and share its result or its exception
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.followers = 0
+        self._flights = dict()
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        """ func(*args), or the result of the call with the same key already running """
+        leader = None
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self.followers += 1
+            else:
+                future = self._flights[key] = Future()
+                self.leaders += 1
+                future.set_running_or_notify_cancel()
+                leader = future
+        if future is not leader:
+            return future.result()
+
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._flights[key]
+        return future.result()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'leaders': self.leaders,
+                'followers': self.followers
+            }
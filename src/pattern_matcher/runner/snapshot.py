@@ -0,0 +1,32 @@
+from types import MappingProxyType
+from ..loader.packed import PackedFrames
+from ..loader.frame_cache import LazyFrames
+
+class DatasetSnapshot:
+    """
+    One loaded version of the matcher data. Loaders build a new snapshot off to the side and the
+    runner publishes it with a single reference swap, a request keeps the snapshot it started with
+    """
+
+    __slots__ = ('frames', 'tickers', 'packed', 'shared', 'version', 'indexes', 'pyramid')
+
+    def __init__(self, frames, packed=None, shared=None, version=0, indexes=None, pyramid=None):
+        # frames backed by packed arrays or parsed on access are already read-only and are not materialized here
+        object.__setattr__(self, 'frames', frames if isinstance(frames, (PackedFrames, LazyFrames)) else MappingProxyType(dict(frames)))
+        object.__setattr__(self, 'tickers', frozenset(frames))
+        object.__setattr__(self, 'packed', packed)
+        object.__setattr__(self, 'shared', shared)
+        object.__setattr__(self, 'version', version)
+        # {window length: WindowIndex} over packed
+        object.__setattr__(self, 'indexes', MappingProxyType(dict(indexes or {})))
+        # ResolutionPyramid over packed
+        object.__setattr__(self, 'pyramid', pyramid)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DatasetSnapshot is immutable')
+
+    def __contains__(self, ticker):
+        return ticker in self.tickers
+
+    def __len__(self):
+        return len(self.tickers)
@@ -0,0 +1,424 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.stats as stats
+import warnings
+
+from pattern_matcher.measurements.pearson import RollingPearson
+from pattern_matcher.measurements.spearmanr import BatchedSpearmanr, sliding_windows
+from pattern_matcher.measurements.banded_dtw import BandedDTW, znormalize_rows
+from pattern_matcher.measurements.combined import CombinedMeasurement
+from pattern_matcher.loader.packed import PackedDataset, ChannelDataset
+from pattern_matcher.loader.frame_cache import FrameCache, LazyFrames
+from pattern_matcher.matcher.matcher import VectorizedMatcher, VectorizedPearsonMatcher, DTWMatcher
+from pattern_matcher.matcher.window_index import WindowIndex
+from pattern_matcher.matcher.pyramid import ResolutionPyramid
+from pattern_matcher.processor.cancellation import CancellationToken
+from pattern_matcher.processor.job import Job
+from pattern_matcher.processor.scheduler import JobScheduler, SchedulerBusy, DeadlineExpired
+from pattern_matcher.processor.worker_pool import ShardedWorkerPool
+from pattern_matcher.runner.runner import EventStream, Runner
+from pattern_matcher.runner.result_cache import ResultCache
+from pattern_matcher.runner.single_flight import SingleFlight
+
+_DAY = 86400000
+
+def split_adjusted(n, low, high, seed=0):
+    """ A long history drifting from low to high, like a split-adjusted price """
+    rng = np.random.RandomState(seed)
+    trend = np.linspace(np.log(low), np.log(high), n) + 0.3 * np.cumsum(rng.randn(n)) / np.sqrt(n)
+    return np.round(np.exp(trend) * (1 + 0.01 * rng.randn(n)), 4)
+
+def mixed_universe(n_tickers=400, length=300, seed=1):
+    """ A PackedDataset of random walks at price levels from 0.5 to 400,000 """
+    rng = np.random.RandomState(seed)
+    levels = np.exp(np.linspace(np.log(0.5), np.log(400000), n_tickers))
+    rng.shuffle(levels)
+    tickers = ['T{0:03d}'.format(i) for i in range(n_tickers)]
+    series = dict()
+    for ticker, level in zip(tickers, levels):
+        closes = np.round(level * np.exp(0.02 * np.cumsum(rng.randn(length))), 4)
+        series[ticker] = (np.arange(length, dtype=np.int64) * _DAY, closes)
+    return PackedDataset.from_series(tickers, lambda ticker: series[ticker])
+
+def per_ticker_results(matcher, dataset, pattern, days_forward):
+    """ (ticker, score, start date) of the best window of every ticker scanned one by one, best first """
+    results = []
+    for ticker in dataset.tickers:
+        dates, closes = dataset.series(ticker)
+        try:
+            ticker, score, (_, match_dates, _, _), _, _ = matcher.match_arrays(0, ticker, dates, closes, pattern, days_forward)
+        except ValueError:
+            continue
+        results.append((ticker, score, match_dates[0]))
+    return sorted(results, key=lambda result: -result[1])
+
+def index_words(index):
+    """ {window start: SAX word} of a built WindowIndex """
+    words = dict()
+    for k in range(index.words.shape[0]):
+        for start in index.starts[index.buckets[k]:index.buckets[k + 1]]:
+            words[int(start)] = tuple(index.words[k])
+    return words
+
+def tickers_unless(begin_time, shard, failing):
+    """ A worker pool function failing on the shard holding the ticker failing """
+    if failing in shard.tickers:
+        raise ValueError('failing shard')
+    return list(shard.tickers)
+
+def file_runner(data_dir):
+    """ A Runner reading ticker files from data_dir, without loading them """
+    runner = Runner.__new__(Runner)
+    runner._DATA_PATH, runner._FORMAT, runner._file_state = str(data_dir), '.csv', dict()
+    return runner
+
+_ROWS = ['date,open,close', '2020-01-02,1,10', '2020-01-03,1,11', '2020-01-06,1,12', '2020-01-07,1,13']
+
+def in_flight(flight, key, func, followers):
+    """ Outcomes of a leader and followers calling flight.do(key, func) while func is still running """
+    outcomes = []
+
+    def call():
+        try:
+            outcomes.append(flight.do(key, func))
+        except Exception as e:
+            outcomes.append(e)
+    threads = [threading.Thread(target=call) for _ in range(followers + 1)]
+    threads[0].start()
+    while flight.stats()['in_flight'] == 0:
+        time.sleep(0.01)
+    for thread in threads[1:]:
+        thread.start()
+    while flight.stats()['followers'] < followers:
+        time.sleep(0.01)
+    return threads, outcomes
+
+def summary(results):
+    return [(ticker, score, match_dates[0]) for ticker, score, (_, match_dates, _, _), _, _ in results]
+
+def assert_same_results(results, expected):
+    assert [result[0] for result in results] == [result[0] for result in expected]
+    assert [result[2] for result in results] == [result[2] for result in expected]
+    np.testing.assert_allclose([result[1] for result in results], [result[1] for result in expected], rtol=0, atol=1e-12)
+
+def test_rolling_pearson_long_history():
+    series = split_adjusted(10000, 0.1, 837)
+    pattern = series[5000:5030] * 3 + 1
+    expected = np.array([np.corrcoef(pattern, series[i:i + 30])[0, 1] for i in range(series.shape[0] - 29)])
+
+    scores = RollingPearson().measure_windows(pattern, series)
+    assert not np.isnan(scores).any()
+    np.testing.assert_allclose(scores, expected, rtol=0, atol=1e-12)
+
+    many = RollingPearson().measure_windows_many(np.stack([pattern, np.ones(30)]), series)
+    np.testing.assert_allclose(many[:, 0], expected, rtol=0, atol=1e-12)
+    assert np.isnan(many[:, 1]).all()
+
+def test_rolling_pearson_flat_windows():
+    series = np.concatenate((np.full(50, 400000.), np.full(50, 0.5)))
+    assert np.isnan(RollingPearson().measure_windows(np.arange(30.), series)[[0, 20, 70]]).all()
+
+def test_packed_pearson_mixed_price_levels():
+    dataset = mixed_universe()
+    pattern = dataset.series('T123')[1][100:130] * 1.5
+    matcher = VectorizedPearsonMatcher()
+    expected = per_ticker_results(matcher, dataset, pattern, 10)
+
+    assert len(summary(matcher.match_packed(0, dataset, pattern, 10))) == len(expected) == len(dataset)
+    assert_same_results(summary(matcher.match_packed(0, dataset, pattern, 10, top=10)), expected[:10])
+
+def test_window_index_words_ignore_neighbours():
+    dataset = mixed_universe()
+    cheapest = int(np.argmin([dataset.series(ticker)[1].mean() for ticker in dataset.tickers]))
+    words = index_words(WindowIndex(30).build(dataset))
+    alone = index_words(WindowIndex(30).build(dataset.slice(cheapest, cheapest + 1)))
+
+    fr = int(dataset.offsets[cheapest])
+    assert len(alone) > 0
+    assert all(words[fr + start] == word for start, word in alone.items())
+
+def test_pyramid_recall_against_brute_force():
+    dataset = mixed_universe(length=600)
+    pattern = dataset.series('T007')[1][200:290]
+    matcher = VectorizedPearsonMatcher()
+    expected = summary(matcher.match_packed(0, dataset, pattern, 10, top=20))
+
+    def pyramid_results(regions):
+        pyramid = ResolutionPyramid((21, 5), regions, 10).build(dataset)
+        return summary(matcher.match_candidates(0, dataset, pyramid.candidates(pattern), pattern, 10, top=20))
+
+    def recall(results):
+        return len(set(result[0] for result in results) & set(result[0] for result in expected))
+
+    # keeping every start verifies the whole universe
+    assert_same_results(pyramid_results(10 ** 6), expected)
+    # the default finds the full-scan top on this corpus, few regions trade recall for speed
+    assert recall(pyramid_results(2000)) == 20
+    assert recall(pyramid_results(20)) < 20
+
+def test_chunked_pearson_matches_packed():
+    dataset = mixed_universe()
+    pattern = dataset.series('T045')[1][150:180]
+    for per_ticker in (1, 3):
+        matcher = VectorizedPearsonMatcher(per_ticker=per_ticker)
+        for top in (None, 10):
+            expected = summary(matcher.match_packed(0, dataset, pattern, 10, top=top))
+            # about 1000 windows a chunk, a ticker's windows span chunk edges
+            assert_same_results(summary(matcher.match_chunked(0, dataset, pattern, 10, top=top, memory=128 * 1000)), expected)
+
+def test_chunked_dtw_stays_within_memory():
+    dataset = mixed_universe(n_tickers=20, length=400)
+    pattern = dataset.series('T012')[1][200:230]
+    memory = 2 ** 19
+    for per_ticker in (1, 3):
+        matcher = DTWMatcher(per_ticker=per_ticker)
+        expected = summary(matcher.match_packed(0, dataset, pattern, 10, top=10))
+        tracemalloc.start()
+        try:
+            results = summary(matcher.match_chunked(0, dataset, pattern, 10, top=10, memory=memory))
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert_same_results(results, expected)
+        # the per-ticker bests and the results themselves come on top of the working arrays
+        assert peak < 2 * memory
+
+def test_channels_score_every_ticker_alone():
+    dataset = mixed_universe()
+    pattern = dataset.series('T210')[1][40:70]
+    matcher = VectorizedPearsonMatcher()
+    channels = ChannelDataset.of(dataset, [dataset.closes, dataset.closes * 1000.])
+    expected = summary(matcher.match_packed(0, dataset, pattern, 10, top=10))
+
+    assert_same_results(summary(matcher.match_channels(0, channels, [pattern, pattern * 1000.], [1., 0.5], 10, top=10)), expected)
+    # a part scored as the processor hands it out under a token
+    part = summary(matcher.match_channels(0, channels.slice(100, 200), [pattern, pattern], [1., 1.], 10, top=10))
+    assert_same_results(part, summary(matcher.match_packed(0, dataset.slice(100, 200), pattern, 10, top=10)))
+
+def test_scanned_frames_do_not_evict_lookups():
+    frames = LazyFrames(['A', 'B', 'C'], FrameCache(10 ** 6), lambda ticker: np.arange(1000.))
+    pattern = frames['A']
+    assert all(frames.stream(ticker) is not None for ticker in frames)
+    assert frames.stream('A') is pattern
+    assert frames.cache.stats()['tickers'] == 1
+    assert frames.cache.stats()['loads'] == 3
+
+def test_queued_job_leaves_at_its_deadline():
+    scheduler = JobScheduler(1, 4)
+    started = threading.Event()
+    release = threading.Event()
+    long_scan = threading.Thread(target=scheduler.run, args=(Job('long', lambda: (started.set(), release.wait())),))
+    long_scan.start()
+    started.wait()
+
+    begin = time.time()
+    try:
+        scheduler.run(Job('short', lambda: None), token=CancellationToken(0.1))
+        assert False, 'an expired job was run'
+    except DeadlineExpired:
+        assert time.time() - begin < 0.5
+    assert scheduler.stats()['queued'] == 0 and scheduler.stats()['expired'] == 1
+    release.set()
+    long_scan.join()
+    assert scheduler.run(Job('next', lambda: 'ran')) == 'ran'
+
+def test_stream_holds_no_turn_between_events():
+    scheduler = JobScheduler(1, 4)
+    job = Job('stream', None)
+    scheduler.admit(job)
+    running = []
+
+    def events():
+        for event in range(3):
+            running.append(scheduler.stats()['running'])
+            yield event
+    stream = EventStream(events(), None, lambda: scheduler.admit(job, None, False) or True, lambda: scheduler.release(job))
+    assert next(stream) == 0 and scheduler.stats()['running'] == 0
+    assert next(stream) == 1 and scheduler.stats()['running'] == 0
+    stream.close()
+    assert running == [1, 1] and scheduler.stats()['running'] == 0
+
+def test_failed_shard_is_not_a_complete_answer():
+    dataset = mixed_universe(n_tickers=20, length=50)
+    dataset.version = 1
+    pool = ShardedWorkerPool(2)
+    try:
+        pool.load(dataset)
+        assert sorted(pool.map(tickers_unless, 0, ('none',))) == sorted(dataset.tickers)
+        try:
+            pool.map(tickers_unless, 0, ('T003',))
+            assert False, 'a failed shard was dropped silently'
+        except Exception as e:
+            assert 'Failed to process shard' in str(e)
+        parts = list(pool.map_iter(tickers_unless, 0, ('T003',), token=CancellationToken()))
+        assert sorted(whole for _, _, whole in parts) == [False, True]
+    finally:
+        pool.close()
+
+def test_read_ticker_leaves_an_unterminated_row(tmp_path):
+    (tmp_path / 'T.csv').write_text('\n'.join(_ROWS[:3]) + '\n' + _ROWS[3][:7])
+    runner = file_runner(tmp_path)
+    assert runner.read_ticker('T')['close'].tolist() == [10, 11]
+    state = runner._file_state['T']
+    assert state.offset == len('\n'.join(_ROWS[:3]) + '\n') and state.last_line == (_ROWS[2] + '\n').encode()
+
+def test_read_appended_rows(tmp_path):
+    (tmp_path / 'T.csv').write_text('\n'.join(_ROWS[:3]) + '\n' + _ROWS[3][:7])
+    runner = file_runner(tmp_path)
+    runner.read_ticker('T')
+    assert runner.read_appended('T', runner._file_state['T']).shape[0] == 0
+    with open(str(tmp_path / 'T.csv'), 'a') as f:
+        f.write(_ROWS[3][7:] + '\n' + _ROWS[4] + '\n')
+    rows = runner.read_appended('T', runner._file_state['T'])
+    fresh = file_runner(tmp_path)
+    expected = fresh.read_ticker('T')
+    assert rows.values.tolist() == expected.values[2:].tolist()
+    assert runner._file_state['T'][2:] == fresh._file_state['T'][2:]
+    assert runner.read_appended('T', runner._file_state['T']).shape[0] == 0
+
+def test_read_appended_gives_up_on_rewritten_files(tmp_path):
+    (tmp_path / 'T.csv').write_text('\n'.join(_ROWS[:4]) + '\n')
+    runner = file_runner(tmp_path)
+    runner.read_ticker('T')
+    state = runner._file_state['T']
+    # truncated
+    (tmp_path / 'T.csv').write_text('\n'.join(_ROWS[:3]) + '\n')
+    assert runner.read_appended('T', state) is None
+    # rewritten with a different last line read
+    (tmp_path / 'T.csv').write_text('\n'.join(_ROWS[:3] + ['2020-01-07,1,14', _ROWS[4]]) + '\n')
+    assert runner.read_appended('T', state) is None
+    # same last line, but the rows after it go back in time
+    (tmp_path / 'T.csv').write_text('\n'.join(_ROWS[:4] + ['2020-01-03,1,15']) + '\n')
+    assert runner.read_appended('T', state) is None
+    assert runner._file_state['T'] == state
+
+def test_batched_spearman_against_scipy():
+    rng = np.random.RandomState(3)
+    # few distinct values make ties in most windows, the flat stretch makes constant windows
+    series = np.concatenate((rng.randint(0, 6, 60), np.full(15, 3), rng.randint(0, 6, 60))).astype(np.float64)
+    patterns = np.array([rng.randint(0, 4, 10), np.arange(10)], dtype=np.float64)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expected = np.array([[stats.spearmanr(pattern, series[i:i + 10])[0] for pattern in patterns] for i in range(series.shape[0] - 9)])
+    assert np.isnan(expected[:, 0]).any()
+    measurement = BatchedSpearmanr(chunk_size=7)
+    for k, pattern in enumerate(patterns):
+        np.testing.assert_allclose(measurement.measure_windows(pattern, series), expected[:, k], rtol=0, atol=1e-12)
+    np.testing.assert_allclose(measurement.measure_windows_many(patterns, series), expected, rtol=0, atol=1e-12)
+
+def test_pruned_dtw_matches_a_full_banded_scan():
+    dataset = mixed_universe(n_tickers=60, length=200, seed=4)
+    rng = np.random.RandomState(4)
+    closes = dataset.series('T007')[1]
+    pattern = closes[50:80] * (1 + 0.02 * rng.randn(30))
+    matcher = DTWMatcher(window=0.1, batch_size=16)
+    for top in (1, 10):
+        # the unpruned scan scores every window with the full banded DTW
+        expected = summary(VectorizedMatcher.match_packed(matcher, 0, dataset, pattern, 10, 1, top))
+        assert_same_results(summary(matcher.match_packed(0, dataset, pattern, 10, 1, top)), expected)
+        assert_same_results(summary(matcher.match_chunked(0, dataset, pattern, 10, 1, top, 2 ** 16)), expected)
+
+def test_result_cache_evicts_least_recently_used():
+    cache = ResultCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1 and cache.stats()['size'] == 2
+
+def test_result_cache_expires_entries():
+    cache = ResultCache(4, ttl=0.05)
+    cache.put('a', 1)
+    assert cache.get('a') == 1
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    assert cache.stats()['size'] == 0 and cache.stats()['evictions'] == 1
+
+def test_scheduler_runs_queued_jobs_in_arrival_order():
+    scheduler = JobScheduler(1, 4)
+    started = threading.Event()
+    release = threading.Event()
+    scheduler.submit(Job('long', lambda: (started.set(), release.wait())))
+    started.wait()
+    order = []
+    jobs = [scheduler.submit(Job(name, order.append, name)) for name in ('a', 'b', 'c')]
+    assert [scheduler.position(job) for job in jobs] == [1, 2, 3]
+    release.set()
+    for _ in range(100):
+        if len(order) == 3:
+            break
+        time.sleep(0.05)
+    assert order == ['a', 'b', 'c'] and all(job.status == 'done' for job in jobs)
+
+def test_scheduler_refuses_beyond_the_queue():
+    scheduler = JobScheduler(1, 1)
+    started = threading.Event()
+    release = threading.Event()
+    scheduler.submit(Job('long', lambda: (started.set(), release.wait())))
+    started.wait()
+    scheduler.submit(Job('queued', lambda: None))
+    try:
+        scheduler.submit(Job('refused', lambda: None))
+        assert False, 'a job was queued beyond queue_size'
+    except SchedulerBusy as e:
+        # answered with 429 and a Retry-After of e.retry_after seconds
+        assert e.queued == 1 and e.retry_after >= 1
+    assert scheduler.stats()['rejected'] == 1
+    release.set()
+
+def test_unread_stream_gives_its_turn_back():
+    scheduler = JobScheduler(1, 4)
+    job = Job('stream', None)
+    scheduler.admit(job)
+    assert scheduler.stats()['running'] == 1
+    # a HEAD request closes the response without reading an event
+    stream = EventStream(iter([]), None, lambda: scheduler.admit(job, None, False) or True, lambda: scheduler.release(job))
+    stream.close()
+    stream.close()
+    assert scheduler.stats()['running'] == 0
+    assert scheduler.run(Job('next', lambda: 'ran')) == 'ran'
+
+def test_single_flight_runs_once_for_its_followers():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+    threads, outcomes = in_flight(flight, 'k', lambda: (calls.append(1), release.wait(), 'result')[2], 3)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert calls == [1] and outcomes == ['result'] * 4
+    assert flight.stats() == {'in_flight': 0, 'leaders': 1, 'followers': 3}
+    assert flight.do('k', lambda: 'again') == 'again'
+
+def test_single_flight_shares_the_exception():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fail():
+        release.wait()
+        raise ValueError('scan failed')
+    threads, outcomes = in_flight(flight, 'k', fail, 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(outcomes) == 3 and all(isinstance(outcome, ValueError) for outcome in outcomes)
+    assert flight.stats()['in_flight'] == 0
+
+def test_combined_dtw_on_the_correlation_scale():
+    series = split_adjusted(400, 10, 50, seed=5)
+    pattern = series[100:130] * (1 + 0.01 * np.random.RandomState(5).randn(30))
+    query, windows = znormalize_rows(pattern), znormalize_rows(sliding_windows(series, 30))
+    pearson = RollingPearson().measure_normalized(query, windows)
+    dtw = BandedDTW(0.1).correlation_normalized(query, windows)
+    # the identity path is in the band, warping only improves on the correlation
+    assert (dtw >= pearson - 1e-12).all() and (dtw <= 1).all()
+    combined = CombinedMeasurement([RollingPearson(), BandedDTW(0.1)], chunk_size=64).measure_windows(pattern, series)
+    np.testing.assert_allclose(combined, (pearson + dtw) / 2, rtol=0, atol=1e-12)